@@ -0,0 +1,188 @@
+import os
+import io
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import resource
+import contextlib
+import tracemalloc
+from types import SimpleNamespace
+
+from lldm import LLDM_Assistant
+from fake_openai import FakeOpenAI
+
+# End-to-end turn benchmark for LLDM_Assistant, run against the local fake Assistants
+# backend so only our own overhead (plus any simulated model latency) is measured.
+#
+#   python bench.py --turns 200 --campaign-sizes 0 2000 --inventory-sizes 0 20000
+#
+# campaign size = messages already in the campaign thread
+# inventory size = inventory history rows already in the DB, spread over other characters,
+#                  the benchmarked character holds up to one of every world item
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+def tool_call(name, arguments, call_id='call'):
+    return SimpleNamespace(id=call_id, function=SimpleNamespace(name=name, arguments=json.dumps(arguments)))
+
+def world_item_names(db_name):
+    with contextlib.closing(sqlite3.connect(db_name)) as db:
+        return [name for (name,) in db.execute('SELECT DISTINCT Weapon_Name FROM WORLD_ITEMS ORDER BY Item_ID')]
+
+def seed_inventory(db_name, inventory_size, rng):
+    with contextlib.closing(sqlite3.connect(db_name)) as db:
+        item_ids = [item_id for (item_id,) in db.execute('SELECT Item_ID FROM WORLD_ITEMS')]
+        history = []
+        for i in range(inventory_size):
+            # campaign 0 character 0 is the benchmarked one, everyone else is background load
+            history.append((1 + i % 50, i % 7, rng.choice(item_ids), rng.randint(1, 5)))
+        with db:
+            db.executemany('INSERT INTO CHARACTER_INVENTORY_HISTORY (Campaign_ID, Character_ID, Item_ID, Quantity) VALUES (?, ?, ?, ?)', history)
+            db.execute('''
+            INSERT INTO CHARACTER_INVENTORY (Campaign_ID, Character_ID, Item_ID, Total_Quantity)
+            SELECT Campaign_ID, Character_ID, Item_ID, SUM(Quantity) FROM CHARACTER_INVENTORY_HISTORY
+            GROUP BY Campaign_ID, Character_ID, Item_ID
+            ON CONFLICT (Campaign_ID, Character_ID, Item_ID) DO UPDATE SET Total_Quantity = excluded.Total_Quantity
+            ''')
+
+def seed_thread(backend, thread_id, campaign_size):
+    for i in range(campaign_size):
+        role = 'user' if i % 2 == 0 else 'assistant'
+        backend.create_message(thread_id, role, f'Earlier turn {i // 2}: the party presses on through the Whispering Woods.')
+
+# one scripted run per turn: pickups, discards, inventory questions or plain narration
+def turn_script(names, rng, held):
+    def script(user_message):
+        roll = rng.random()
+        if roll < 0.35:
+            picked = rng.sample(names, rng.randint(1, 3))
+            held.update(picked)
+            calls = [('get_obtained_item', {'item_name': name, 'quantity': rng.randint(1, 3)}) for name in picked]
+            return {'tool_calls': [calls], 'reply': 'You stow the items in your pack.'}
+        if roll < 0.5 and held:
+            name = rng.choice(sorted(held))
+            return {'tool_calls': [[('get_discarded_item', {'item_name': name, 'quantity': 1})]], 'reply': 'You leave it behind.'}
+        if roll < 0.8:
+            query = rng.choice([
+                'SELECT SUM(Total_Quantity) AS Total FROM CHARACTER_INVENTORY_DETAILS',
+                'SELECT Weapon_Name, Total_Quantity FROM CHARACTER_INVENTORY_DETAILS',
+                'SELECT Weapon_Name, Quantity, Modify_Time FROM CHARACTER_INVENTORY_HISTORY_DETAILS ORDER BY Modify_Time DESC LIMIT 5',
+            ])
+            return {'tool_calls': [[('get_item_info', {'sql_query': query})]], 'reply': 'You check your pack.'}
+        return {'reply': 'The wind howls through the trees.'}
+    return script
+
+def bench_turns(template_db, work_dir, turns, campaign_size, inventory_size, latency, use_streaming, seed):
+    rng = random.Random(seed)
+    db_name = os.path.join(work_dir, f'turns-{campaign_size}-{inventory_size}.db')
+    shutil.copyfile(template_db, db_name)
+    seed_inventory(db_name, inventory_size, rng)
+    names = world_item_names(db_name)
+
+    client = FakeOpenAI(turn_script(names, rng, set()), latency)
+    with contextlib.redirect_stdout(io.StringIO()):
+        assistant = LLDM_Assistant(None, db_name, use_streaming=use_streaming, client=client)
+        seed_thread(client.backend, assistant.thread_id, campaign_size)
+        assistant.narrator_chat('Warm up.')
+
+        turn_times = []
+        tool_times = []
+        tracemalloc.start()
+        for i in range(turns):
+            start = time.perf_counter()
+            assistant.narrator_chat(f'Turn {i}.')
+            turn_times.append(time.perf_counter() - start)
+            if 'tool_calls' in assistant.last_turn_timings:
+                tool_times.append(assistant.last_turn_timings['tool_calls'])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'turn_p50_ms': percentile(turn_times, 50) * 1e3,
+        'turn_p99_ms': percentile(turn_times, 99) * 1e3,
+        'tool_dispatch_p50_ms': percentile(tool_times, 50) * 1e3,
+        'tool_dispatch_p99_ms': percentile(tool_times, 99) * 1e3,
+        'peak_traced_mb': peak / 2**20,
+    }
+
+# obtain/discard throughput straight through the tool dispatcher, one group commit per call
+def bench_mutations(template_db, work_dir, operations, inventory_size, seed):
+    rng = random.Random(seed)
+    db_name = os.path.join(work_dir, f'mutations-{inventory_size}.db')
+    shutil.copyfile(template_db, db_name)
+    seed_inventory(db_name, inventory_size, rng)
+    names = world_item_names(db_name)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        assistant = LLDM_Assistant(None, db_name, client=FakeOpenAI())
+        start = time.perf_counter()
+        for i in range(operations):
+            name = names[i % len(names)]
+            if i % 2 == 0:
+                assistant._run_tool_calls([tool_call('get_obtained_item', {'item_name': name, 'quantity': 2})])
+            else:
+                assistant._run_tool_calls([tool_call('get_discarded_item', {'item_name': name, 'quantity': 1})])
+        elapsed = time.perf_counter() - start
+    return {'mutations_per_sec': operations / elapsed}
+
+def build_template(excel_db_filename, work_dir):
+    db_name = os.path.join(work_dir, 'template.db')
+    with contextlib.redirect_stdout(io.StringIO()):
+        assistant = LLDM_Assistant(None, db_name, excel_db_filename, client=FakeOpenAI())
+        # threads only exist in the fake backend that created them
+        with assistant.db:
+            assistant.db.execute('DELETE FROM NARRATOR_THREADS')
+        assistant.db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        assistant.db.close()
+    return db_name
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark narrator turns against the local fake Assistants backend.')
+    parser.add_argument('--excel', default='DnD.xlsx')
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--mutations', type=int, default=2000)
+    parser.add_argument('--campaign-sizes', type=int, nargs='+', default=[0, 2000])
+    parser.add_argument('--inventory-sizes', type=int, nargs='+', default=[0, 20000])
+    parser.add_argument('--model-latency', type=float, default=0.0, help='simulated seconds per model step')
+    parser.add_argument('--request-latency', type=float, default=0.0, help='simulated seconds per API call')
+    parser.add_argument('--polling', action='store_true', help='use the polling run driver instead of streaming')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    latency = {'model': args.model_latency, 'request': args.request_latency}
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='lldm-bench-')
+    try:
+        template_db = build_template(args.excel, work_dir)
+        for inventory_size in args.inventory_sizes:
+            mutations = bench_mutations(template_db, work_dir, args.mutations, inventory_size, args.seed)
+            for campaign_size in args.campaign_sizes:
+                result = {'campaign_size': campaign_size, 'inventory_size': inventory_size}
+                result.update(bench_turns(template_db, work_dir, args.turns, campaign_size, inventory_size, latency, not args.polling, args.seed))
+                result.update(mutations)
+                results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    columns = list(results[0])
+    print(' '.join(f'{column:>22}' for column in columns))
+    for result in results:
+        print(' '.join(f'{result[column]:>22.3f}' if isinstance(result[column], float) else f'{result[column]:>22}' for column in columns))
+    print(f'max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
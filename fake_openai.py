@@ -0,0 +1,435 @@
+import json
+import time
+import asyncio
+import itertools
+import threading
+from types import SimpleNamespace
+
+# Local stand-in for the parts of the OpenAI Assistants API that LLDM_Assistant uses, for
+# benchmarks and offline runs. Runs follow scripts instead of a model:
+#
+#   {'tool_calls': [[('get_obtained_item', {'item_name': 'Divine Bow', 'quantity': 1})]],
+#    'reply': 'You pick up the bow.',
+#    'status': 'completed'}
+#
+# each entry of tool_calls is one requires_action step, the run then ends with the given
+# status ('completed' posts the reply, 'failed', 'expired', 'cancelled' and 'incomplete'
+# end the run without one). The script can be a list consumed one run at a time or a
+# callable taking the latest user message. Latencies are in seconds: 'request' is added to
+# every API call, 'model' to every model step (before each requires_action and before the
+# run ends).
+#
+# chat.completions only serves the thread summaries of LLDM_Assistant's context manager: the
+# reply is a JSON summary with every 'user: ...' line of the transcript as an event, or
+# whatever summarize(messages) returns when given.
+
+DEFAULT_RUN = {'tool_calls': [], 'reply': 'The story continues.', 'status': 'completed'}
+
+
+class FakeAssistantsBackend:
+
+    def __init__(self, script=None, latency=None, summarize=None):
+        self.script = script if script is not None else []
+        self.summarize = summarize
+        self.latency = {'request': 0.0, 'model': 0.0, **(latency or {})}
+        self.assistants = {}
+        self.threads = {}       # thread_id -> list of messages, oldest first
+        self.runs = {}
+        self.calls = {}         # API method -> number of calls, for checking round trips
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+
+    def __new_id(self, prefix):
+        return f'{prefix}_{next(self.__ids)}'
+
+    def __count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def __next_script(self, thread_id):
+        if callable(self.script):
+            user_messages = [m for m in self.threads[thread_id] if m.role == 'user']
+            last = user_messages[-1].content[0].text.value if user_messages else ''
+            return {**DEFAULT_RUN, **self.script(last.strip())}
+        if self.script:
+            return {**DEFAULT_RUN, **self.script.pop(0)}
+        return dict(DEFAULT_RUN)
+
+    # every public method returns (result, seconds the caller should wait before returning it)
+
+    def create_assistant(self, **config):
+        with self.__lock:
+            self.__count('assistants.create')
+            assistant = SimpleNamespace(id=self.__new_id('asst'), **config)
+            self.assistants[assistant.id] = assistant
+        return assistant, self.latency['request']
+
+    def delete_assistant(self, assistant_id):
+        with self.__lock:
+            self.__count('assistants.delete')
+            self.assistants.pop(assistant_id, None)
+        return SimpleNamespace(id=assistant_id, deleted=True), self.latency['request']
+
+    def create_thread(self, messages=None):
+        with self.__lock:
+            self.__count('threads.create')
+            thread = SimpleNamespace(id=self.__new_id('thread'))
+            self.threads[thread.id] = []
+        for message in messages or []:
+            self.create_message(thread.id, message['role'], message['content'])
+        return thread, self.latency['request']
+
+    def create_message(self, thread_id, role, content, assistant_id=None):
+        with self.__lock:
+            self.__count('messages.create')
+            message = SimpleNamespace(
+                id=self.__new_id('msg'),
+                thread_id=thread_id,
+                role=role,
+                assistant_id=assistant_id,
+                content=[SimpleNamespace(type='text', text=SimpleNamespace(value=content, annotations=[]))],
+            )
+            self.threads[thread_id].append(message)
+        return message, self.latency['request']
+
+    def complete_chat(self, model, messages, **options):
+        with self.__lock:
+            self.__count('chat.completions.create')
+        if self.summarize is not None:
+            content = self.summarize(messages)
+        else:
+            transcript = messages[-1]['content']
+            events = [line[len('user: '):].strip() for line in transcript.splitlines() if line.startswith('user: ')]
+            content = json.dumps({'summary': f'The party played {len(events)} turns.', 'events': events})
+        completion = SimpleNamespace(
+            id=self.__new_id('chatcmpl'),
+            model=model,
+            choices=[SimpleNamespace(index=0, finish_reason='stop', message=SimpleNamespace(role='assistant', content=content))],
+        )
+        return completion, self.latency['request'] + self.latency['model']
+
+    def list_messages(self, thread_id, after=None, limit=20, order='desc'):
+        with self.__lock:
+            self.__count('messages.list')
+            messages = self.threads[thread_id]
+            if order == 'desc':
+                messages = messages[::-1]
+            if after is not None:
+                ids = [m.id for m in messages]
+                messages = messages[ids.index(after) + 1:]
+            page = SimpleNamespace(data=messages[:limit], has_more=len(messages) > limit)
+        return page, self.latency['request']
+
+    def create_run(self, thread_id, assistant_id, **options):
+        with self.__lock:
+            self.__count('runs.create')
+            run = SimpleNamespace(
+                id=self.__new_id('run'),
+                thread_id=thread_id,
+                assistant_id=assistant_id,
+                status='queued',
+                required_action=None,
+                last_error=None,
+                options=options,
+            )
+            script = self.__next_script(thread_id)
+            run.steps = list(script['tool_calls'])
+            run.final_status = script['status']
+            run.reply = script['reply']
+            run.ready_at = time.monotonic() + self.latency['model']
+            self.runs[run.id] = run
+        return self.__snapshot(run), self.latency['request']
+
+    def retrieve_run(self, thread_id, run_id):
+        with self.__lock:
+            self.__count('runs.retrieve')
+            run = self.runs[run_id]
+            self.__advance(run)
+        return self.__snapshot(run), self.latency['request']
+
+    def submit_tool_outputs(self, thread_id, run_id, tool_outputs):
+        with self.__lock:
+            self.__count('runs.submit_tool_outputs')
+            run = self.runs[run_id]
+            if run.status != 'requires_action':
+                raise ValueError(f'Run {run_id} is not waiting for tool outputs ({run.status}).')
+            expected = {tool_call.id for tool_call in run.required_action.submit_tool_outputs.tool_calls}
+            submitted = {output['tool_call_id'] for output in tool_outputs}
+            if expected != submitted:
+                raise ValueError(f'Tool outputs {sorted(submitted)} do not match tool calls {sorted(expected)}.')
+            run.tool_outputs = list(tool_outputs)
+            run.status = 'queued'
+            run.required_action = None
+            run.ready_at = time.monotonic() + self.latency['model']
+        return self.__snapshot(run), self.latency['request']
+
+    def cancel_run(self, thread_id, run_id):
+        with self.__lock:
+            self.__count('runs.cancel')
+            run = self.runs[run_id]
+            run.status = 'cancelled'
+            run.required_action = None
+        return self.__snapshot(run), self.latency['request']
+
+    # seconds until the run's next model step is done
+    def wait_time(self, run_id):
+        return max(0.0, self.runs[run_id].ready_at - time.monotonic())
+
+    # move the run forward once its model step is done
+    def __advance(self, run):
+        if run.status not in ('queued', 'in_progress'):
+            return
+        if time.monotonic() < run.ready_at:
+            run.status = 'in_progress'
+            return
+        if run.steps:
+            tool_calls = [
+                SimpleNamespace(
+                    id=self.__new_id('call'),
+                    type='function',
+                    function=SimpleNamespace(name=name, arguments=json.dumps(arguments)),
+                )
+                for name, arguments in run.steps.pop(0)
+            ]
+            run.status = 'requires_action'
+            run.required_action = SimpleNamespace(
+                type='submit_tool_outputs',
+                submit_tool_outputs=SimpleNamespace(tool_calls=tool_calls),
+            )
+            return
+        run.status = run.final_status
+        if run.status == 'completed':
+            message = SimpleNamespace(
+                id=self.__new_id('msg'),
+                thread_id=run.thread_id,
+                role='assistant',
+                assistant_id=run.assistant_id,
+                content=[SimpleNamespace(type='text', text=SimpleNamespace(value=run.reply, annotations=[]))],
+            )
+            self.threads[run.thread_id].append(message)
+        elif run.status == 'failed':
+            run.last_error = SimpleNamespace(code='server_error', message='Scripted failure.')
+
+    # copy handed to callers, later changes to the run do not show through
+    def __snapshot(self, run):
+        return SimpleNamespace(
+            id=run.id,
+            thread_id=run.thread_id,
+            assistant_id=run.assistant_id,
+            status=run.status,
+            required_action=run.required_action,
+            last_error=run.last_error,
+        )
+
+    # stream events up to the next requires_action or the end of the run
+    def run_events(self, run_id):
+        events = []
+        with self.__lock:
+            run = self.runs[run_id]
+            self.__advance(run)
+            snapshot = self.__snapshot(run)
+        if snapshot.status in ('queued', 'in_progress'):
+            events.append(SimpleNamespace(event=f'thread.run.{snapshot.status}', data=snapshot))
+        return events, snapshot
+
+
+class _Resource:
+
+    def __init__(self, backend):
+        self._backend = backend
+
+
+# sync facade, mirrors OpenAI().beta
+
+class _Assistants(_Resource):
+
+    def create(self, **config):
+        return _wait(self._backend.create_assistant(**config))
+
+    def delete(self, assistant_id):
+        return _wait(self._backend.delete_assistant(assistant_id))
+
+
+class _Messages(_Resource):
+
+    def create(self, thread_id, role, content, **options):
+        return _wait(self._backend.create_message(thread_id, role, content))
+
+    def list(self, thread_id, after=None, limit=20, order='desc', **options):
+        return _wait(self._backend.list_messages(thread_id, after=after, limit=limit, order=order))
+
+
+class _StreamManager:
+
+    def __init__(self, backend, start):
+        self._backend = backend
+        self._start = start
+
+    def __enter__(self):
+        return self._events()
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def _events(self):
+        run = _wait(self._start())
+        yield SimpleNamespace(event='thread.run.created', data=run)
+        while True:
+            time.sleep(self._backend.wait_time(run.id))
+            events, run = self._backend.run_events(run.id)
+            yield from events
+            if run.status not in ('queued', 'in_progress'):
+                yield SimpleNamespace(event=f'thread.run.{run.status}', data=run)
+                return
+
+
+class _Runs(_Resource):
+
+    def create(self, thread_id, assistant_id, **options):
+        return _wait(self._backend.create_run(thread_id, assistant_id, **options))
+
+    def retrieve(self, run_id, thread_id):
+        return _wait(self._backend.retrieve_run(thread_id, run_id))
+
+    def submit_tool_outputs(self, run_id, thread_id, tool_outputs):
+        return _wait(self._backend.submit_tool_outputs(thread_id, run_id, tool_outputs))
+
+    def cancel(self, run_id, thread_id):
+        return _wait(self._backend.cancel_run(thread_id, run_id))
+
+    def stream(self, thread_id, assistant_id, **options):
+        return _StreamManager(self._backend, lambda: self._backend.create_run(thread_id, assistant_id, **options))
+
+    def submit_tool_outputs_stream(self, run_id, thread_id, tool_outputs):
+        return _StreamManager(self._backend, lambda: self._backend.submit_tool_outputs(thread_id, run_id, tool_outputs))
+
+
+class _Threads(_Resource):
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.messages = _Messages(backend)
+        self.runs = _Runs(backend)
+
+    def create(self, messages=None, **options):
+        return _wait(self._backend.create_thread(messages))
+
+
+def _wait(result):
+    value, delay = result
+    if delay:
+        time.sleep(delay)
+    return value
+
+
+class _Completions(_Resource):
+
+    def create(self, model, messages, **options):
+        return _wait(self._backend.complete_chat(model, messages, **options))
+
+
+class FakeOpenAI:
+
+    def __init__(self, script=None, latency=None, backend=None, summarize=None):
+        self.backend = backend or FakeAssistantsBackend(script, latency, summarize)
+        self.beta = SimpleNamespace(
+            assistants=_Assistants(self.backend),
+            threads=_Threads(self.backend),
+        )
+        self.chat = SimpleNamespace(completions=_Completions(self.backend))
+
+
+# async facade, mirrors AsyncOpenAI().beta
+
+class _AsyncAssistants(_Resource):
+
+    async def create(self, **config):
+        return await _await(self._backend.create_assistant(**config))
+
+    async def delete(self, assistant_id):
+        return await _await(self._backend.delete_assistant(assistant_id))
+
+
+class _AsyncMessages(_Resource):
+
+    async def create(self, thread_id, role, content, **options):
+        return await _await(self._backend.create_message(thread_id, role, content))
+
+    async def list(self, thread_id, after=None, limit=20, order='desc', **options):
+        return await _await(self._backend.list_messages(thread_id, after=after, limit=limit, order=order))
+
+
+class _AsyncStreamManager(_StreamManager):
+
+    async def __aenter__(self):
+        return self._aevents()
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def _aevents(self):
+        run = await _await(self._start())
+        yield SimpleNamespace(event='thread.run.created', data=run)
+        while True:
+            await asyncio.sleep(self._backend.wait_time(run.id))
+            events, run = self._backend.run_events(run.id)
+            for event in events:
+                yield event
+            if run.status not in ('queued', 'in_progress'):
+                yield SimpleNamespace(event=f'thread.run.{run.status}', data=run)
+                return
+
+
+class _AsyncRuns(_Resource):
+
+    async def create(self, thread_id, assistant_id, **options):
+        return await _await(self._backend.create_run(thread_id, assistant_id, **options))
+
+    async def retrieve(self, run_id, thread_id):
+        return await _await(self._backend.retrieve_run(thread_id, run_id))
+
+    async def submit_tool_outputs(self, run_id, thread_id, tool_outputs):
+        return await _await(self._backend.submit_tool_outputs(thread_id, run_id, tool_outputs))
+
+    async def cancel(self, run_id, thread_id):
+        return await _await(self._backend.cancel_run(thread_id, run_id))
+
+    def stream(self, thread_id, assistant_id, **options):
+        return _AsyncStreamManager(self._backend, lambda: self._backend.create_run(thread_id, assistant_id, **options))
+
+    def submit_tool_outputs_stream(self, run_id, thread_id, tool_outputs):
+        return _AsyncStreamManager(self._backend, lambda: self._backend.submit_tool_outputs(thread_id, run_id, tool_outputs))
+
+
+class _AsyncThreads(_Resource):
+
+    def __init__(self, backend):
+        super().__init__(backend)
+        self.messages = _AsyncMessages(backend)
+        self.runs = _AsyncRuns(backend)
+
+    async def create(self, messages=None, **options):
+        return await _await(self._backend.create_thread(messages))
+
+
+async def _await(result):
+    value, delay = result
+    if delay:
+        await asyncio.sleep(delay)
+    return value
+
+
+class _AsyncCompletions(_Resource):
+
+    async def create(self, model, messages, **options):
+        return await _await(self._backend.complete_chat(model, messages, **options))
+
+
+class FakeAsyncOpenAI:
+
+    def __init__(self, script=None, latency=None, backend=None, summarize=None):
+        self.backend = backend or FakeAssistantsBackend(script, latency, summarize)
+        self.beta = SimpleNamespace(
+            assistants=_AsyncAssistants(self.backend),
+            threads=_AsyncThreads(self.backend),
+        )
+        self.chat = SimpleNamespace(completions=_AsyncCompletions(self.backend))
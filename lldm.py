@@ -1,11 +1,1658 @@
 import os
 import yaml
 import json
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import sqlite3
-import pandas as pd
 import time
 import sqlglot
+import asyncio
+import threading
+import queue
+import pathlib
+import contextlib
+import re
+import bisect
+import collections
+import collections.abc
+import hashlib
+import itertools
+import functools
+import tempfile
+import shutil
+import datetime
+import contextvars
+import uuid
+import openpyxl
+from concurrent.futures import ThreadPoolExecutor
+
+# run statuses/stream events after which the Assistants API will not touch the run again
+RUN_TERMINAL_STATUSES = ('completed', 'cancelled', 'failed', 'expired', 'incomplete')
+RUN_TERMINAL_EVENTS = tuple(f'thread.run.{status}' for status in RUN_TERMINAL_STATUSES)
+
+# adaptive backoff bounds (seconds) for the polling fallback
+POLL_MIN_INTERVAL = 0.1
+POLL_MAX_INTERVAL = 2.0
+POLL_BACKOFF = 1.5
+
+# messages requested per messages.list call when catching up on a thread
+HISTORY_PAGE_SIZE = 100
+
+# threads shared by every async assistant for blocking sqlite work
+DB_EXECUTOR_WORKERS = 8
+
+# threads shared by every assistant for running read-only tool calls of one step in parallel
+READ_EXECUTOR_WORKERS = 4
+# idle read-only connections kept open per database
+READER_POOL_SIZE = 4
+
+# assistants a SessionManager keeps open, and the seconds after which an idle one is dropped
+SESSION_MAX_ASSISTANTS = 64
+SESSION_IDLE_TIMEOUT = 30 * 60
+
+# tool calls that modify the inventory, applied together in one transaction per step
+MUTATING_TOOLS = ('get_obtained_item', 'get_discarded_item')
+
+# item name resolution: minimum score for a confident match, and how far ahead of the
+# runner-up a non-exact match has to be
+CATALOG_MATCH_THRESHOLD = 0.6
+CATALOG_MATCH_MARGIN = 0.1
+CATALOG_CANDIDATES = 5
+
+# PRAGMA user_version of a database with the current schema, see __migrate_db
+SCHEMA_VERSION = 5
+
+# prepared statements kept per connection, every inventory mutation uses the fixed,
+# parameterized SQL below so it is compiled once
+STATEMENT_CACHE_SIZE = 256
+
+# mutable inventory state, one row per (campaign, character, item), plus the change log
+INVENTORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY (
+    Campaign_ID INTEGER NOT NULL,
+    Character_ID INTEGER NOT NULL,
+    Item_ID INTEGER NOT NULL,
+    Total_Quantity FLOAT DEFAULT 0,
+    PRIMARY KEY (Campaign_ID, Character_ID, Item_ID)
+);
+
+-- AUTOINCREMENT so IDs of archived rows are never handed out again, checkpoints mark their
+-- position in the log by History_ID
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_HISTORY (
+    History_ID INTEGER PRIMARY KEY AUTOINCREMENT,
+    Campaign_ID INTEGER NOT NULL,
+    Character_ID INTEGER NOT NULL,
+    Item_ID INTEGER NOT NULL,
+    Quantity FLOAT DEFAULT 0,
+    Modify_Time DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_TIME
+ON CHARACTER_INVENTORY_HISTORY (Campaign_ID, Character_ID, Modify_Time);
+
+-- bumped with every inventory change of a character, cached get_item_info results are only
+-- served while it is unchanged
+CREATE TABLE IF NOT EXISTS INVENTORY_GENERATION (
+    Campaign_ID INTEGER NOT NULL,
+    Character_ID INTEGER NOT NULL,
+    Generation INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (Campaign_ID, Character_ID)
+);
+'''
+
+# narrator assistants by configuration hash, and the thread each campaign plays in
+REGISTRY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS NARRATOR_ASSISTANTS (
+    Config_Hash TEXT NOT NULL PRIMARY KEY,
+    Assistant_ID TEXT NOT NULL,
+    Create_Time DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS NARRATOR_THREADS (
+    Campaign_ID INTEGER NOT NULL PRIMARY KEY,
+    Thread_ID TEXT NOT NULL,
+    Create_Time DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+'''
+
+# schema version 0 had no keys, move the old rows aside and copy them into the keyed tables,
+# summing duplicate inventory rows and dropping the emptied ones
+INVENTORY_KEYS_MIGRATION = '''
+BEGIN;
+
+DROP VIEW IF EXISTS CHARACTER_INVENTORY_DETAILS;
+DROP VIEW IF EXISTS CHARACTER_INVENTORY_HISTORY_DETAILS;
+
+ALTER TABLE CHARACTER_INVENTORY RENAME TO CHARACTER_INVENTORY_V0;
+ALTER TABLE CHARACTER_INVENTORY_HISTORY RENAME TO CHARACTER_INVENTORY_HISTORY_V0;
+''' + INVENTORY_SCHEMA + '''
+INSERT INTO CHARACTER_INVENTORY (Campaign_ID, Character_ID, Item_ID, Total_Quantity)
+SELECT Campaign_ID, Character_ID, Item_ID, SUM(Total_Quantity)
+FROM CHARACTER_INVENTORY_V0
+GROUP BY Campaign_ID, Character_ID, Item_ID
+HAVING SUM(Total_Quantity) > 0;
+
+INSERT INTO CHARACTER_INVENTORY_HISTORY (Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time)
+SELECT Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time
+FROM CHARACTER_INVENTORY_HISTORY_V0
+ORDER BY rowid;
+
+DROP TABLE CHARACTER_INVENTORY_V0;
+DROP TABLE CHARACTER_INVENTORY_HISTORY_V0;
+
+COMMIT;
+'''
+
+# schema version 3 history IDs could be reused once the newest rows were archived
+HISTORY_AUTOINCREMENT_MIGRATION = '''
+BEGIN;
+
+DROP VIEW IF EXISTS CHARACTER_INVENTORY_HISTORY_DETAILS;
+DROP INDEX IF EXISTS CHARACTER_INVENTORY_HISTORY_TIME;
+ALTER TABLE CHARACTER_INVENTORY_HISTORY RENAME TO CHARACTER_INVENTORY_HISTORY_V3;
+''' + INVENTORY_SCHEMA + '''
+INSERT INTO CHARACTER_INVENTORY_HISTORY (History_ID, Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time)
+SELECT History_ID, Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time
+FROM CHARACTER_INVENTORY_HISTORY_V3
+ORDER BY History_ID;
+
+DROP TABLE CHARACTER_INVENTORY_HISTORY_V3;
+
+COMMIT;
+'''
+
+# history compaction: CHARACTER_INVENTORY_HISTORY only keeps the recent rows, older ones move to
+# the archive and are summed per play session into the rollup
+# a checkpoint holds a character's totals as of Last_History_ID, the inventory can be rebuilt
+# from the newest checkpoint plus the history after it
+HISTORY_COMPACTION_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_CHECKPOINT (
+    Checkpoint_ID INTEGER PRIMARY KEY,
+    Campaign_ID INTEGER NOT NULL,
+    Character_ID INTEGER NOT NULL,
+    Last_History_ID INTEGER NOT NULL,
+    Generation INTEGER NOT NULL DEFAULT 0,
+    Checkpoint_Time DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS CHARACTER_INVENTORY_CHECKPOINT_CHARACTER
+ON CHARACTER_INVENTORY_CHECKPOINT (Campaign_ID, Character_ID, Checkpoint_ID);
+
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_CHECKPOINT_ITEMS (
+    Checkpoint_ID INTEGER NOT NULL,
+    Item_ID INTEGER NOT NULL,
+    Total_Quantity FLOAT DEFAULT 0,
+    PRIMARY KEY (Checkpoint_ID, Item_ID)
+);
+
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_ARCHIVE (
+    History_ID INTEGER PRIMARY KEY,
+    Campaign_ID INTEGER NOT NULL,
+    Character_ID INTEGER NOT NULL,
+    Item_ID INTEGER NOT NULL,
+    Quantity FLOAT DEFAULT 0,
+    Modify_Time DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_ARCHIVE_TIME
+ON CHARACTER_INVENTORY_HISTORY_ARCHIVE (Campaign_ID, Character_ID, Modify_Time);
+
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_ROLLUP (
+    Campaign_ID INTEGER NOT NULL,
+    Character_ID INTEGER NOT NULL,
+    Session_Start DATETIME NOT NULL,
+    Item_ID INTEGER NOT NULL,
+    Session_End DATETIME NOT NULL,
+    Quantity FLOAT DEFAULT 0,
+    Change_Count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (Campaign_ID, Character_ID, Session_Start, Item_ID)
+);
+
+-- bumped by every compaction, cached get_item_info results over the history are dropped with it
+CREATE TABLE IF NOT EXISTS HISTORY_VERSION (
+    Version INTEGER NOT NULL
+);
+
+INSERT INTO HISTORY_VERSION (Version)
+SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM HISTORY_VERSION);
+'''
+
+# the inventory tables joined with the world catalog, the views the model queries
+# a view in the main schema cannot read an attached database, so campaign shards create these
+# as TEMP views on every connection instead, see ShardRouter
+INVENTORY_VIEWS = '''
+CREATE VIEW IF NOT EXISTS CHARACTER_INVENTORY_DETAILS 
+AS
+SELECT
+    a.Campaign_ID, a.Character_ID, a.Item_ID, a.Total_Quantity,
+    b.Weapon_Name, b.Weapon_Description
+FROM CHARACTER_INVENTORY a
+JOIN WORLD_ITEMS b ON a.Item_ID = b.Item_ID;
+
+CREATE VIEW IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_DETAILS 
+AS
+SELECT
+    a.Campaign_ID, a.Character_ID, a.Item_ID, a.Quantity, a.Modify_Time,
+    b.Weapon_Name, b.Weapon_Description
+FROM CHARACTER_INVENTORY_HISTORY a
+JOIN WORLD_ITEMS b ON a.Item_ID = b.Item_ID;
+
+CREATE VIEW IF NOT EXISTS CHARACTER_INVENTORY_SESSION_DETAILS
+AS
+SELECT
+    a.Campaign_ID, a.Character_ID, a.Item_ID, a.Session_Start, a.Session_End, a.Quantity,
+    b.Weapon_Name, b.Weapon_Description
+FROM CHARACTER_INVENTORY_ROLLUP a
+JOIN WORLD_ITEMS b ON a.Item_ID = b.Item_ID;
+'''
+
+TEMP_INVENTORY_VIEWS = INVENTORY_VIEWS.replace('CREATE VIEW', 'CREATE TEMP VIEW')
+
+OBTAIN_ITEM_SQL = '''
+INSERT INTO CHARACTER_INVENTORY (Campaign_ID, Character_ID, Item_ID, Total_Quantity) VALUES (?, ?, ?, ?)
+ON CONFLICT (Campaign_ID, Character_ID, Item_ID) DO UPDATE SET Total_Quantity = Total_Quantity + excluded.Total_Quantity
+'''
+
+# only matches when the character holds at least the discarded amount
+DISCARD_ITEM_SQL = '''
+UPDATE CHARACTER_INVENTORY SET Total_Quantity = Total_Quantity - ?
+WHERE Campaign_ID = ? AND Character_ID = ? AND Item_ID = ? AND Total_Quantity >= ?
+'''
+
+REMOVE_EMPTY_ITEM_SQL = '''
+DELETE FROM CHARACTER_INVENTORY
+WHERE Campaign_ID = ? AND Character_ID = ? AND Item_ID = ? AND Total_Quantity <= 0
+'''
+
+RECORD_HISTORY_SQL = '''
+INSERT INTO CHARACTER_INVENTORY_HISTORY (Campaign_ID, Character_ID, Item_ID, Quantity) VALUES (?, ?, ?, ?)
+'''
+
+# prebuilt template databases live in this directory next to the workbook
+TEMPLATE_DIR = '.lldm_templates'
+
+# rows read before creating a sheet's table to pick its column types
+SHEET_TYPE_SAMPLE_ROWS = 1000
+
+# ID column and extra campaign columns of the table built from each workbook sheet
+SHEET_TABLES = {
+    'CHARACTER_SHEET': ('Character_ID', ('Campaign_ID INTEGER',)),
+    'INVENTORY': ('Item_ID', ()),
+    'WORLD_ITEMS': ('Item_ID', ()),
+    'SETTINGS': ('Setting_ID', ()),
+    'NPCS': ('NPC_ID', ()),
+    'TREASURES': ('Treasure_ID', ()),
+    'MONSTERS': ('Monster_ID', ()),
+    'PLOT': ('Plot_ID', ('Campaign_ID INTEGER',)),
+    'LOGS': ('Log_ID', ('Campaign_ID INTEGER', 'Character_ID INTEGER')),
+}
+
+# static sheets that go into the shared world DB when campaigns are sharded, the rest of the
+# template is per-campaign state
+WORLD_TABLES = ('WORLD_ITEMS', 'WORLD_ITEMS_VERSION', 'SETTINGS', 'NPCS', 'TREASURES', 'MONSTERS')
+
+# bytes of the world DB every shard connection maps into memory
+WORLD_MMAP_SIZE = 256 * 2**20
+
+# directory DB of a shard directory, the campaign -> file map and the shared narrator assistants
+SHARD_DIRECTORY_DB = 'shards.db'
+
+SHARD_DIRECTORY_SCHEMA = REGISTRY_SCHEMA + '''
+CREATE TABLE IF NOT EXISTS CAMPAIGN_SHARDS (
+    Campaign_ID INTEGER NOT NULL PRIMARY KEY,
+    File_Name TEXT NOT NULL,
+    Create_Time DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+'''
+
+CAMPAIGN_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS CAMPAIGN (
+    Campaign_ID INTEGER NOT NULL,
+    Setting TEXT NOT NULL,
+    Start_Time TEXT NOT NULL,
+    Current_Turns INTEGER NOT NULL DEFAULT 0
+);
+'''
+
+# the template is rebuilt from scratch if loading fails, so skip journaling and syncing
+BULK_LOAD_PRAGMAS = '''
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+PRAGMA locking_mode = EXCLUSIVE;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -65536;
+'''
+
+BUMP_GENERATION_SQL = '''
+INSERT INTO INVENTORY_GENERATION (Campaign_ID, Character_ID, Generation) VALUES (?, ?, 1)
+ON CONFLICT (Campaign_ID, Character_ID) DO UPDATE SET Generation = Generation + 1
+'''
+
+# the views the model queries also read WORLD_ITEMS and the compacted history, so their
+# versions are part of the generation
+GET_GENERATION_SQL = '''
+SELECT
+    (SELECT Generation FROM INVENTORY_GENERATION WHERE Campaign_ID = ? AND Character_ID = ?),
+    (SELECT Version FROM WORLD_ITEMS_VERSION),
+    (SELECT Version FROM HISTORY_VERSION)
+'''
+
+# a checkpoint is written every CHECKPOINT_INTERVAL inventory changes of a character
+# compaction keeps HISTORY_HOT_DAYS of raw history, rows further apart than
+# ROLLUP_SESSION_GAP belong to different play sessions
+CHECKPOINT_INTERVAL = 500
+CHECKPOINTS_KEPT = 3
+HISTORY_HOT_DAYS = 7
+ROLLUP_SESSION_GAP = datetime.timedelta(hours=1)
+
+# the sequence is the highest History_ID ever handed out, archived rows included
+WRITE_CHECKPOINT_SQL = '''
+INSERT INTO CHARACTER_INVENTORY_CHECKPOINT (Campaign_ID, Character_ID, Last_History_ID, Generation)
+SELECT :campaign_id, :character_id,
+    COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'CHARACTER_INVENTORY_HISTORY'), 0),
+    COALESCE((SELECT Generation FROM INVENTORY_GENERATION WHERE Campaign_ID = :campaign_id AND Character_ID = :character_id), 0)
+'''
+
+WRITE_CHECKPOINT_ITEMS_SQL = '''
+INSERT INTO CHARACTER_INVENTORY_CHECKPOINT_ITEMS (Checkpoint_ID, Item_ID, Total_Quantity)
+SELECT :checkpoint_id, Item_ID, Total_Quantity FROM CHARACTER_INVENTORY
+WHERE Campaign_ID = :campaign_id AND Character_ID = :character_id
+'''
+
+LAST_CHECKPOINT_SQL = '''
+SELECT Checkpoint_ID, Last_History_ID, Generation FROM CHARACTER_INVENTORY_CHECKPOINT
+WHERE Campaign_ID = ? AND Character_ID = ?
+ORDER BY Checkpoint_ID DESC LIMIT 1
+'''
+
+# newest checkpoint plus every change logged after it, hot or archived
+REBUILD_INVENTORY_SQL = '''
+WITH checkpoint AS (
+    SELECT Checkpoint_ID, Last_History_ID FROM CHARACTER_INVENTORY_CHECKPOINT
+    WHERE Campaign_ID = :campaign_id AND Character_ID = :character_id
+    ORDER BY Checkpoint_ID DESC LIMIT 1
+)
+SELECT Item_ID, SUM(Quantity) FROM (
+    SELECT Item_ID, Total_Quantity AS Quantity FROM CHARACTER_INVENTORY_CHECKPOINT_ITEMS
+    WHERE Checkpoint_ID = (SELECT Checkpoint_ID FROM checkpoint)
+    UNION ALL
+    SELECT Item_ID, Quantity FROM CHARACTER_INVENTORY_HISTORY
+    WHERE Campaign_ID = :campaign_id AND Character_ID = :character_id
+    AND History_ID > COALESCE((SELECT Last_History_ID FROM checkpoint), 0)
+    UNION ALL
+    SELECT Item_ID, Quantity FROM CHARACTER_INVENTORY_HISTORY_ARCHIVE
+    WHERE Campaign_ID = :campaign_id AND Character_ID = :character_id
+    AND History_ID > COALESCE((SELECT Last_History_ID FROM checkpoint), 0)
+)
+GROUP BY Item_ID
+HAVING SUM(Quantity) > 0
+'''
+
+# checkpoints past the newest CHECKPOINTS_KEPT of each character
+PRUNE_CHECKPOINTS_SQL = '''
+DELETE FROM CHARACTER_INVENTORY_CHECKPOINT WHERE Checkpoint_ID IN (
+    SELECT Checkpoint_ID FROM (
+        SELECT Checkpoint_ID, ROW_NUMBER() OVER (
+            PARTITION BY Campaign_ID, Character_ID ORDER BY Checkpoint_ID DESC
+        ) AS Position
+        FROM CHARACTER_INVENTORY_CHECKPOINT
+    ) WHERE Position > ?
+)
+'''
+
+PRUNE_CHECKPOINT_ITEMS_SQL = '''
+DELETE FROM CHARACTER_INVENTORY_CHECKPOINT_ITEMS
+WHERE Checkpoint_ID NOT IN (SELECT Checkpoint_ID FROM CHARACTER_INVENTORY_CHECKPOINT)
+'''
+
+ROLLUP_SQL = '''
+INSERT INTO CHARACTER_INVENTORY_ROLLUP (Campaign_ID, Character_ID, Session_Start, Item_ID, Session_End, Quantity, Change_Count)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (Campaign_ID, Character_ID, Session_Start, Item_ID) DO UPDATE SET
+    Session_End = MAX(Session_End, excluded.Session_End),
+    Quantity = Quantity + excluded.Quantity,
+    Change_Count = Change_Count + excluded.Change_Count
+'''
+
+# get_item_info caches: normalized query -> rewritten SQL (shared by every assistant), and
+# per assistant (rewritten SQL, campaign, character) -> tool output
+QUERY_REWRITE_CACHE_SIZE = 512
+QUERY_RESULT_CACHE_SIZE = 256
+
+# bounds for the model's get_item_info queries: rows sent back, wall-clock and VM-step budget
+# (the progress handler runs every QUERY_PROGRESS_STEPS instructions), and the estimated size
+# above which a plan may not fully scan a table
+QUERY_MAX_ROWS = 200
+QUERY_TIME_BUDGET = 0.5
+QUERY_STEP_BUDGET = 5000000
+QUERY_PROGRESS_STEPS = 1000
+QUERY_SCAN_MAX_ROWS = 5000
+
+# tool outputs are cut to about this many prompt tokens, estimated at TOKEN_CHARS characters each
+TOOL_RESULT_TOKEN_BUDGET = 1000
+TOKEN_CHARS = 4
+
+# in-memory inventory of the session's character, deltas kept for clients catching up
+INVENTORY_DELTA_LOG_SIZE = 256
+
+LOAD_INVENTORY_SQL = '''
+SELECT Item_ID, Weapon_Name, Weapon_Description, Total_Quantity FROM CHARACTER_INVENTORY_DETAILS
+WHERE Campaign_ID = ? AND Character_ID = ?
+ORDER BY Item_ID
+'''
+
+ITEM_DETAILS_SQL = '''
+SELECT Weapon_Name, Weapon_Description FROM WORLD_ITEMS WHERE Item_ID = ?
+'''
+
+# inventory questions answered without a run when the router is at least this confident
+FAST_PATH_CONFIDENCE = 0.8
+RECENT_PICKUPS = 5
+
+# the last RECENT_PICKUPS pickups, summed per item
+RECENT_PICKUPS_SQL = '''
+SELECT Weapon_Name, SUM(Quantity) FROM (
+    SELECT Item_ID, Weapon_Name, Quantity, Modify_Time FROM CHARACTER_INVENTORY_HISTORY_DETAILS
+    WHERE Campaign_ID = ? AND Character_ID = ? AND Quantity > 0
+    ORDER BY Modify_Time DESC
+    LIMIT ?
+)
+GROUP BY Item_ID
+ORDER BY MAX(Modify_Time) DESC, Item_ID
+'''
+
+# campaign memory: LOGS holds one row per summarized event and PLOT one row per thread summary,
+# LOGS_SEARCH indexes the events for retrieval (needs FTS5, without it the newest events are used)
+MEMORY_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS LOGS (
+    Log_ID INTEGER PRIMARY KEY,
+    Time TEXT,
+    Event TEXT,
+    X_Coordinate TEXT,
+    Y_Coordinate TEXT,
+    Campaign_ID INTEGER,
+    Character_ID INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS PLOT (
+    Plot_ID INTEGER PRIMARY KEY,
+    Setting TEXT,
+    Description TEXT,
+    Events TEXT,
+    Campaign_ID INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS LOGS_CAMPAIGN ON LOGS (Campaign_ID, Log_ID);
+CREATE INDEX IF NOT EXISTS PLOT_CAMPAIGN ON PLOT (Campaign_ID, Plot_ID);
+'''
+
+LOGS_SEARCH_SCHEMA = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS LOGS_SEARCH USING fts5(Event, content='LOGS');
+
+CREATE TRIGGER IF NOT EXISTS LOGS_SEARCH_INSERT AFTER INSERT ON LOGS
+BEGIN
+    INSERT INTO LOGS_SEARCH (rowid, Event) VALUES (new.rowid, new.Event);
+END;
+
+CREATE TRIGGER IF NOT EXISTS LOGS_SEARCH_DELETE AFTER DELETE ON LOGS
+BEGIN
+    INSERT INTO LOGS_SEARCH (LOGS_SEARCH, rowid, Event) VALUES ('delete', old.rowid, old.Event);
+END;
+
+CREATE TRIGGER IF NOT EXISTS LOGS_SEARCH_UPDATE AFTER UPDATE OF Event ON LOGS
+BEGIN
+    INSERT INTO LOGS_SEARCH (LOGS_SEARCH, rowid, Event) VALUES ('delete', old.rowid, old.Event);
+    INSERT INTO LOGS_SEARCH (rowid, Event) VALUES (new.rowid, new.Event);
+END;
+'''
+
+SEARCH_EVENTS_SQL = '''
+SELECT l.Time, l.Event FROM LOGS_SEARCH s
+JOIN LOGS l ON l.rowid = s.rowid
+WHERE LOGS_SEARCH MATCH ? AND l.Campaign_ID = ?
+ORDER BY bm25(LOGS_SEARCH)
+LIMIT ?
+'''
+
+RECENT_EVENTS_SQL = '''
+SELECT Time, Event FROM LOGS WHERE Campaign_ID = ?
+ORDER BY rowid DESC
+LIMIT ?
+'''
+
+RECORD_EVENT_SQL = '''
+INSERT INTO LOGS (Time, Event, Campaign_ID, Character_ID) VALUES (CURRENT_TIMESTAMP, ?, ?, ?)
+'''
+
+RECORD_SUMMARY_SQL = '''
+INSERT INTO PLOT (Setting, Description, Events, Campaign_ID) VALUES ('Story so far', ?, ?, ?)
+'''
+
+# context window: a turn's prompt (instructions, tools, thread and retrieved events) is kept
+# under CONTEXT_TOKEN_BUDGET by summarizing the thread into a fresh one before it would go over
+# the newest KEEP_RECENT_MESSAGES messages carry over verbatim
+CONTEXT_TOKEN_BUDGET = 8000
+RETRIEVAL_TOKEN_BUDGET = 500
+RETRIEVED_EVENTS = 8
+KEEP_RECENT_MESSAGES = 4
+
+SEARCH_STOPWORDS = frozenset('''
+the and for with that this what from have has had was were are you your into onto then than them they
+there their will would can could should about just some any all out off over under again still
+'''.split())
+
+SUMMARY_INSTRUCTIONS = '''
+You keep the campaign log of a DnD game. Summarize the transcript you are given.
+Reply with a JSON object only, without any preamble or post text:
+{"summary": "<the story so far in at most 150 words, keep names, places, quests and open threads>",
+ "events": ["<one short sentence per notable event, in order>"]}
+'''
+
+# change counter for WORLD_ITEMS, lets ItemCatalog notice edits with a single-row read
+CATALOG_VERSION_SCRIPT = '''
+CREATE TABLE IF NOT EXISTS WORLD_ITEMS_VERSION (
+    Version INTEGER NOT NULL
+);
+
+INSERT INTO WORLD_ITEMS_VERSION (Version)
+SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM WORLD_ITEMS_VERSION);
+
+CREATE TRIGGER IF NOT EXISTS WORLD_ITEMS_INSERT_VERSION AFTER INSERT ON WORLD_ITEMS
+BEGIN
+    UPDATE WORLD_ITEMS_VERSION SET Version = Version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS WORLD_ITEMS_UPDATE_VERSION AFTER UPDATE ON WORLD_ITEMS
+BEGIN
+    UPDATE WORLD_ITEMS_VERSION SET Version = Version + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS WORLD_ITEMS_DELETE_VERSION AFTER DELETE ON WORLD_ITEMS
+BEGIN
+    UPDATE WORLD_ITEMS_VERSION SET Version = Version + 1;
+END;
+'''
+
+# narrator assistant configuration, shared by the sync and async assistants
+GET_INFO_FUNC_DESC = '''
+Generate a SQL query to help extract the information that the user is asking for with regards to the items in their character's inventory, such as taking out or utilizing an item the character possesses. Use the following view to help generate the query, with the description of each column in between asterisks (*):
+
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_DETAILS (
+    Weapon_Name text, 
+    Weapon_Description text ,
+    Total_Quantity int    
+);
+
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_DETAILS (
+    Weapon_Name text, 
+    Weapon_Description text,
+    Quantity int *A positive number represents obtained weapons, while a negative number means discarded*,
+    Modify_Time datetime
+);
+
+CHARACTER_INVENTORY_HISTORY_DETAILS only holds the changes of the last few days. Older changes are summed per play session in this view:
+
+CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_SESSION_DETAILS (
+    Weapon_Name text,
+    Weapon_Description text,
+    Session_Start datetime,
+    Session_End datetime,
+    Quantity int *Net number of the weapon obtained (positive) or discarded (negative) in the session*
+);
+
+Make sure to only query columns that exist from each table. Do not switch column-table identities.
+Only return the SQL query without any preamble or post text, as well as without any quotes. Do not add a semicolon at the end of the query
+Only create SELECT queries and do not create any queries that will modify the table in any way.
+'''
+
+NARRATOR_INSTRUCTIONS = """
+    You are a DnD DM. You sets the scene by describing the environment and atmosphere, brings NPCs to life through detailed character portrayals, and narrates the outcomes of player actions. They establish the game's tone, provide world-building lore, guide the overarching story while balancing player choices, and enforce game rules.
+
+    The information of the main character is as follows: Elara Windrider, a courageous warrior with a heart of gold, is a human fighter who embodies the principles of Lawful Good. She is tall and athletic, with short brown hair, green eyes, and a determined expression. Clad in chain mail and wielding a longsword, Elara's appearance reflects her readiness for battle. Born in a small village, she was trained by her father, a retired soldier. Driven by a desire to protect the innocent and seek justice, she left home to make her mark on the world. Elara is brave and compassionate, possessing a strong sense of justice. Though she is determined and reliable, her stubbornness can sometimes get the best of her.
+
+    The plot summary is as follows:
+
+        The Dragon's Flagon (Tavern)
+    Description: The Dragon's Flagon is a lively tavern with a warm, welcoming atmosphere. The walls are adorned with trophies from past adventurers, and a large fireplace dominates one side of the room.
+    
+        Whispering Woods (Wilderness)
+    Description: Whispering Woods is a foreboding forest with a canopy so thick it blocks out most of the sunlight. The air is filled with the sounds of unseen creatures, and the ground is covered with a thick layer of leaves.
+    
+    Description: Blackstone Keep is a crumbling fortress with tall, dark towers and walls covered in ivy. Inside, it is dark and cold, with the air thick with the smell of decay.
+
+    After receiving user response, you generate a narrative that moves the plot forward while maintaining a realistic continuity of events.
+"""
+
+NARRATOR_TOOLS = [
+    # {"type": "file_search"},
+    {
+        "type": "function",
+        "function": {
+            "name": "get_obtained_item",
+            "description": "Extract the item that the user has obtained in some manner (such as picked up, purchased, etc.). This does not include utilizing an item that the user currently might have in their inventory.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "item_name": {
+                        "type": "string",
+                        "description": "The name of the obtained item.",
+                    },
+                    "quantity": {
+                        "type": "integer",
+                        "description": "The number of said items obtained. If a number is not specified, try and infer based on the surrounding context."
+                    }
+                },
+                "required": ["item_name", "quantity"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_discarded_item",
+            "description": "Extract the item that the user has discarded in some manner (such as thrown away, consumed, broken, etc.)",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "item_name": {
+                        "type": "string",
+                        "description": "The name of the discarded item.",
+                    },
+                    "quantity": {
+                        "type": "integer",
+                        "description": "The number of said items discarded. If a number is not specified, try and infer based on the surrounding context."
+                    }
+                },
+                "required": ["item_name", "quantity"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_item_info",
+            "description": GET_INFO_FUNC_DESC,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "sql_query": {
+                        "type": "string",
+                        "description": "The generated SQL query that would extract the information related to the character inventory requested by the user",
+                    }
+                },
+                "required": ["sql_query"],
+            },
+        },
+    }
+]
+
+NARRATOR_NAME = "narrator"
+NARRATOR_MODEL = "gpt-3.5-turbo"
+# thread summaries for the context window
+SUMMARY_MODEL = NARRATOR_MODEL
+
+NARRATOR_CONFIG = {
+    'name': NARRATOR_NAME,
+    'instructions': NARRATOR_INSTRUCTIONS,
+    'tools': NARRATOR_TOOLS,
+    'model': NARRATOR_MODEL,
+}
+# assistants are reused across restarts for as long as this hash is unchanged
+NARRATOR_CONFIG_HASH = hashlib.sha256(json.dumps(NARRATOR_CONFIG, sort_keys=True).encode()).hexdigest()
+
+
+# latency buckets (seconds) of the Prometheus histograms
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# spans kept in memory when the tracer has no exporter
+TRACE_BUFFER_SIZE = 10000
+
+# queries at least this slow (seconds) go to the tracer's slow query hook
+SLOW_QUERY_THRESHOLD = 0.1
+
+_current_span = contextvars.ContextVar('lldm_current_span', default=None)
+
+# literals out, whitespace collapsed: queries that only differ in their values share a fingerprint
+@functools.lru_cache(maxsize=1024)
+def sql_fingerprint(sql):
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\s+', ' ', sql).strip().rstrip(';').strip()
+    return hashlib.sha1(sql.encode()).hexdigest()[:12], sql
+
+class _Span:
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self.__token = _current_span.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self.__token)
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        self.tracer._finish(self.name, self.start, self.trace_id, self.span_id, self.parent_id, self.attributes)
+        return False
+
+class _NullSpan:
+
+    trace_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+# per-turn tracing and metrics for narrator_chat, tool dispatch and DB queries
+# spans are exported as JSON-ready dicts (to exporter, or kept in recent_spans), metrics
+# accumulate as Prometheus counters/histograms, see prometheus()
+class Tracer:
+
+    enabled = True
+
+    def __init__(self, exporter=None, slow_query_hook=None, slow_query_threshold=SLOW_QUERY_THRESHOLD):
+        self.exporter = exporter
+        self.slow_query_hook = slow_query_hook
+        self.slow_query_threshold = slow_query_threshold
+        self.recent_spans = collections.deque(maxlen=TRACE_BUFFER_SIZE)
+        self.__counters = {}     # (name, labels) -> value
+        self.__histograms = {}   # (name, labels) -> [bucket counts..., sum, count]
+        self.__lock = threading.Lock()
+
+    def span(self, name, **attributes):
+        return _Span(self, name, attributes)
+
+    # span for a phase timed by the caller since start (a time.perf_counter() value)
+    def record(self, name, start, **attributes):
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self._finish(name, start, trace_id, uuid.uuid4().hex[:16], parent.span_id if parent else None, attributes)
+
+    def _finish(self, name, start, trace_id, span_id, parent_id, attributes):
+        duration = time.perf_counter() - start
+        span = {
+            'trace_id': trace_id,
+            'span_id': span_id,
+            'parent_id': parent_id,
+            'name': name,
+            'start_time': time.time() - duration,
+            'duration_ms': duration * 1e3,
+            'attributes': attributes,
+        }
+        self.observe('lldm_span_seconds', duration, span=name)
+        if self.exporter is not None:
+            self.exporter(span)
+        else:
+            self.recent_spans.append(span)
+
+    def query(self, sql, start, rows):
+        duration = time.perf_counter() - start
+        fingerprint, normalized = sql_fingerprint(sql)
+        self.record('db_query', start, fingerprint=fingerprint, rows=rows)
+        self.increment('lldm_db_queries_total', fingerprint=fingerprint)
+        if rows is not None:
+            self.increment('lldm_db_rows_total', rows, fingerprint=fingerprint)
+        self.observe('lldm_db_query_seconds', duration, fingerprint=fingerprint)
+        if duration >= self.slow_query_threshold:
+            self.increment('lldm_db_slow_queries_total', fingerprint=fingerprint)
+            if self.slow_query_hook is not None:
+                self.slow_query_hook({'fingerprint': fingerprint, 'sql': normalized, 'duration': duration, 'rows': rows})
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = [0] * (len(METRIC_BUCKETS) + 2)
+            histogram[bisect.bisect_left(METRIC_BUCKETS, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def spans_json(self):
+        return '\n'.join(json.dumps(span) for span in self.recent_spans)
+
+    # text exposition format
+    def prometheus(self):
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self.__lock:
+            counters = sorted(self.__counters.items())
+            histograms = sorted(self.__histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f'# TYPE {name} counter')
+                seen.add(name)
+            lines.append(f'{name}{label_text(labels)} {value}')
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                lines.append(f'# TYPE {name} histogram')
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS + (float('inf'),), histogram[:-2]):
+                cumulative += count
+                bound = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{name}_bucket{label_text(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{label_text(labels)} {histogram[-2]}')
+            lines.append(f'{name}_count{label_text(labels)} {histogram[-1]}')
+        return '\n'.join(lines) + '\n'
+
+# stand-in used when tracing is off, every call is a no-op
+class _NullTracer:
+
+    enabled = False
+    _span = _NullSpan()
+
+    def span(self, name, **attributes):
+        return self._span
+
+    def record(self, name, start, **attributes):
+        pass
+
+    def query(self, sql, start, rows):
+        pass
+
+    def increment(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+NULL_TRACER = _NullTracer()
+
+# accumulate elapsed time since start under the given phase, and trace it as a span of the turn
+def _add_timing(tracer, timings, phase, start, **attributes):
+    timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+    tracer.record(phase, start, **attributes)
+
+def _report_timings(timings):
+    print('Turn timings:', ', '.join(f'{phase}={seconds:.3f}s' for phase, seconds in timings.items()))
+
+def _report_run_status(run):
+    if run is None:
+        return
+    if run.status == "cancelled":
+        print("Run cancelled.")
+    if run.status == "failed":
+        print("Run failed.")
+    if run.status == "expired":
+        print("Run expired.")
+
+# local, append-only copy of one thread's messages, each turn only lists the messages after
+# the last one already seen instead of re-listing the whole thread
+class ChatHistory:
+
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.last_message_id = None
+        self.__entries = []     # {'role', 'content'}, oldest first
+        self.characters = 0     # total content length, for prompt size estimates
+
+    def __len__(self):
+        return len(self.__entries)
+
+    # arguments for the next messages.list call
+    def list_params(self):
+        params = {'thread_id': self.thread_id, 'order': 'asc', 'limit': HISTORY_PAGE_SIZE}
+        if self.last_message_id is not None:
+            params['after'] = self.last_message_id
+        return params
+
+    # append one page of messages.list, returns the new entries and whether more pages follow
+    def extend(self, page):
+        new_entries = []
+        for thread_message in page.data:
+            for content_item in thread_message.content:
+                new_entries.append({'role': thread_message.role, 'content': content_item.text.value})
+            self.last_message_id = thread_message.id
+        self.__entries.extend(new_entries)
+        self.characters += sum(len(entry['content']) for entry in new_entries)
+        return new_entries, bool(getattr(page, 'has_more', False))
+
+    # newest first, same order as messages.list returned before the history was cached
+    def view(self):
+        return ChatHistoryView(self.__entries)
+
+# read-only, newest-first sequence over a ChatHistory without copying it
+class ChatHistoryView(collections.abc.Sequence):
+
+    def __init__(self, entries):
+        self.__entries = entries
+        self.__length = len(entries)
+
+    def __len__(self):
+        return self.__length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.__length))]
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError('chat history index out of range')
+        return self.__entries[self.__length - 1 - index]
+
+    def __repr__(self):
+        return repr(list(self))
+
+# read-only connections for tool calls that only query, so they can run in parallel with
+# each other and with the writer (under WAL they see the last committed state)
+class ReaderPool:
+
+    # setup runs on every new connection before it turns query-only, e.g. ShardRouter.attach
+    def __init__(self, db_name, max_idle=READER_POOL_SIZE, setup=None):
+        self.uri = pathlib.Path(db_name).resolve().as_uri() + '?mode=ro'
+        self.setup = setup
+        self.__idle = queue.LifoQueue(maxsize=max_idle)
+
+    def __open(self):
+        db = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        if self.setup is not None:
+            self.setup(db)
+        db.execute('PRAGMA query_only = ON')
+        return db
+
+    @contextlib.contextmanager
+    def connection(self):
+        try:
+            db = self.__idle.get_nowait()
+        except queue.Empty:
+            db = self.__open()
+        try:
+            yield db
+        finally:
+            try:
+                self.__idle.put_nowait(db)
+            except queue.Full:
+                db.close()
+
+    def close(self):
+        while True:
+            try:
+                self.__idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+# the connections of one DB file: a single writer, serialized by lock, and the read-only pool
+# next to it, plus the item catalog read through the writer
+# the first assistant opened with the pool connects (and migrates) the file, the others reuse
+# its connections, see LLDM_Assistant._open_db
+class ConnectionPool:
+
+    def __init__(self, max_readers=READER_POOL_SIZE):
+        self.max_readers = max_readers
+        self.lock = threading.RLock()
+        self.db = None
+        self.readers = None
+        self.catalog = None
+
+    def close(self):
+        with self.lock:
+            if self.readers is not None:
+                self.readers.close()
+            if self.db is not None:
+                self.db.close()
+            self.db = self.readers = self.catalog = None
+
+# runs the model's SQL within bounds: the plan may not fully scan a large table, and a query
+# past its time or VM-step budget is interrupted by the progress handler
+# meant for the read-only pool connections, the handler is removed again after every query
+class QueryGuard:
+
+    class QueryRejectedException(Exception):
+        pass
+
+    def __init__(self, time_budget=QUERY_TIME_BUDGET, step_budget=QUERY_STEP_BUDGET, scan_max_rows=QUERY_SCAN_MAX_ROWS):
+        self.time_budget = time_budget
+        self.step_budget = step_budget
+        self.scan_max_rows = scan_max_rows
+        self.__view_aliases = None
+        self.__lock = threading.Lock()
+
+    # alias -> tables it may stand for, the plan names view tables by their alias
+    @staticmethod
+    def __aliases(statement, aliases):
+        for table in statement.find_all(sqlglot.exp.Table):
+            aliases.setdefault(table.alias_or_name, set()).add(table.name)
+            aliases.setdefault(table.name, set()).add(table.name)
+        return aliases
+
+    def __load_view_aliases(self, db):
+        with self.__lock:
+            if self.__view_aliases is None:
+                aliases = {}
+                views = "SELECT sql FROM sqlite_master WHERE type = 'view' UNION ALL SELECT sql FROM sqlite_temp_master WHERE type = 'view'"
+                for (view_sql,) in db.execute(views):
+                    self.__aliases(sqlglot.parse_one(view_sql), aliases)
+                self.__view_aliases = aliases
+            return self.__view_aliases
+
+    # upper bound on a table's rows from its largest rowid, a single index lookup
+    def __estimate_rows(self, db, table):
+        try:
+            return db.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+        except sqlite3.Error:
+            return 0
+
+    def check_plan(self, db, sql, params=()):
+        aliases = {name: set(tables) for name, tables in self.__load_view_aliases(db).items()}
+        self.__aliases(sqlglot.parse_one(sql), aliases)
+        for _, _, _, detail in db.execute('EXPLAIN QUERY PLAN ' + sql, params):
+            match = re.match(r'SCAN (\w+)', detail)
+            if match is None or match.group(1) == 'CONSTANT':
+                continue
+            for table in aliases.get(match.group(1), {match.group(1)}):
+                if self.__estimate_rows(db, table) > self.scan_max_rows:
+                    raise self.QueryRejectedException(f'the query would read all of {table}')
+
+    @contextlib.contextmanager
+    def guard(self, db, sql, params=()):
+        self.check_plan(db, sql, params)
+        deadline = time.perf_counter() + self.time_budget
+        max_calls = self.step_budget // QUERY_PROGRESS_STEPS
+        state = {'calls': 0, 'reason': None}
+
+        def progress():
+            state['calls'] += 1
+            if state['calls'] > max_calls:
+                state['reason'] = 'the query ran too many steps'
+            elif time.perf_counter() > deadline:
+                state['reason'] = 'the query took too long'
+            # non-zero aborts the statement
+            return state['reason'] is not None
+
+        db.set_progress_handler(progress, QUERY_PROGRESS_STEPS)
+        try:
+            yield
+        except Exception:
+            if state['reason'] is not None:
+                raise self.QueryRejectedException(state['reason'])
+            raise
+        finally:
+            db.set_progress_handler(None, QUERY_PROGRESS_STEPS)
+
+# builds the tool output strings: a message plus, for query results, a header and one list per
+# row, JSON-encoded once without whitespace
+# rows past the token budget are dropped for a "N more rows" marker
+class ResultEncoder:
+
+    def __init__(self, token_budget=TOOL_RESULT_TOKEN_BUDGET):
+        self.token_budget = token_budget
+
+    @staticmethod
+    def __dumps(value):
+        return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+    @staticmethod
+    def __compact(value):
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        return value
+
+    # complete=False when rows stopped at a LIMIT and there is at least one more past them
+    def encode(self, message, columns=None, rows=None, complete=True):
+        head = self.__dumps({'message': message})[:-1]
+        if columns is None:
+            return head + '}'
+        head += ',"columns":' + self.__dumps(list(columns)) + ',"rows":['
+        # room for the closing brackets and the marker
+        room = self.token_budget * TOKEN_CHARS - len(head) - 48
+        encoded = []
+        for row in rows:
+            text = self.__dumps([self.__compact(value) for value in row])
+            room -= len(text) + 1
+            if room < 0:
+                break
+            encoded.append(text)
+        output = head + ','.join(encoded) + ']'
+        more = len(rows) - len(encoded)
+        if not complete:
+            output += ',"more_rows":' + self.__dumps(f"at least {more + 1} more rows")
+        elif more:
+            output += ',"more_rows":' + self.__dumps(f"{more} more rows")
+        return output + '}'
+
+# bounded, thread-safe least-recently-used mapping
+class LRUCache:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.__data = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            try:
+                self.__data.move_to_end(key)
+            except KeyError:
+                return default
+            return self.__data[key]
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            if len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+# in-memory index over WORLD_ITEMS for resolving the item names the model passes to the tools,
+# reloaded only when the WORLD_ITEMS_VERSION counter kept by triggers on the table changes
+class ItemCatalog:
+
+    def __init__(self, db, lock):
+        self.db = db
+        self.lock = lock
+        self.__version = None
+        self.__items = {}       # normalized name -> (Item_ID, Weapon_Name)
+        self.__prefixes = []    # sorted normalized names, for prefix lookups
+        self.__trigrams = {}    # trigram -> normalized names containing it
+        self.__sizes = {}       # normalized name -> number of distinct trigrams
+
+    @staticmethod
+    def normalize(name):
+        words = re.sub(r'[^a-z0-9]+', ' ', str(name).lower()).split()
+        while words and words[0] in ('the', 'a', 'an'):
+            words = words[1:]
+        return ' '.join(words)
+
+    @staticmethod
+    def trigrams(text):
+        text = f'  {text} '
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def invalidate(self):
+        self.__version = None
+
+    def __refresh(self):
+        version = self.db.execute('SELECT Version FROM WORLD_ITEMS_VERSION').fetchone()[0]
+        if version == self.__version:
+            return
+        items = {}
+        # same order as the old LIKE lookup, so duplicate names still resolve to the first row
+        for item_id, item_name in self.db.execute('SELECT Item_ID, Weapon_Name FROM WORLD_ITEMS ORDER BY rowid'):
+            key = self.normalize(item_name)
+            if key and key not in items:
+                items[key] = (int(item_id), item_name)
+        trigrams = {}
+        sizes = {}
+        for key in items:
+            key_trigrams = self.trigrams(key)
+            sizes[key] = len(key_trigrams)
+            for trigram in key_trigrams:
+                trigrams.setdefault(trigram, []).append(key)
+        self.__items = items
+        self.__prefixes = sorted(items)
+        self.__trigrams = trigrams
+        self.__sizes = sizes
+        self.__version = version
+
+    # ranked (Item_ID, Weapon_Name, score) candidates, score 1.0 is an exact match
+    def candidates(self, item_name, limit=CATALOG_CANDIDATES):
+        query = self.normalize(item_name)
+        if not query:
+            return []
+        with self.lock:
+            self.__refresh()
+            scores = {}
+            if query in self.__items:
+                scores[query] = 1.0
+            # prefix matches rank just below exact ones, closer lengths first
+            i = bisect.bisect_left(self.__prefixes, query)
+            while i < len(self.__prefixes) and self.__prefixes[i].startswith(query):
+                key = self.__prefixes[i]
+                scores.setdefault(key, 0.8 + 0.2 * len(query) / len(key))
+                i += 1
+            # fuzzy matches by trigram overlap (Dice coefficient), covers paraphrased names
+            query_trigrams = self.trigrams(query)
+            shared = {}
+            for trigram in query_trigrams:
+                for key in self.__trigrams.get(trigram, ()):
+                    shared[key] = shared.get(key, 0) + 1
+            for key, count in shared.items():
+                score = 2 * count / (len(query_trigrams) + self.__sizes[key])
+                if score > scores.get(key, 0.0):
+                    scores[key] = score
+            ranked = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))[:limit]
+            return [(*self.__items[key], score) for key, score in ranked]
+
+    # the single confident match for item_name, or None when nothing is close enough or
+    # the best candidates are too close to call
+    def resolve(self, item_name):
+        candidates = self.candidates(item_name, limit=2)
+        if not candidates or candidates[0][2] < CATALOG_MATCH_THRESHOLD:
+            return None
+        if candidates[0][2] < 1.0 and len(candidates) > 1 and candidates[0][2] - candidates[1][2] < CATALOG_MATCH_MARGIN:
+            return None
+        return candidates[0]
+
+# assistant and thread IDs persisted in the campaign DB, so a restarted process reconnects to
+# the same narrator and thread without any API calls
+# assistants may live in another DB than the threads, e.g. the directory DB of a ShardRouter
+class AssistantRegistry:
+
+    def __init__(self, db, lock, assistant_db=None, assistant_lock=None):
+        self.db = db
+        self.lock = lock
+        self.assistant_db = assistant_db or db
+        self.assistant_lock = assistant_lock or lock
+
+    def assistant_id(self, config_hash):
+        with self.assistant_lock:
+            row = self.assistant_db.execute('SELECT Assistant_ID FROM NARRATOR_ASSISTANTS WHERE Config_Hash = ?', (config_hash,)).fetchone()
+        return row[0] if row else None
+
+    # record the assistant for config_hash, returns the IDs of assistants built from older
+    # configurations so the caller can delete them
+    def save_assistant(self, config_hash, assistant_id):
+        with self.assistant_lock:
+            stale = [row[0] for row in self.assistant_db.execute('SELECT Assistant_ID FROM NARRATOR_ASSISTANTS WHERE Config_Hash <> ?', (config_hash,))]
+            with self.assistant_db:
+                self.assistant_db.execute('DELETE FROM NARRATOR_ASSISTANTS WHERE Config_Hash <> ?', (config_hash,))
+                self.assistant_db.execute('INSERT OR REPLACE INTO NARRATOR_ASSISTANTS (Config_Hash, Assistant_ID) VALUES (?, ?)', (config_hash, assistant_id))
+        return stale
+
+    def thread_id(self, campaign_id):
+        with self.lock:
+            row = self.db.execute('SELECT Thread_ID FROM NARRATOR_THREADS WHERE Campaign_ID = ?', (campaign_id,)).fetchone()
+        return row[0] if row else None
+
+    def save_thread(self, campaign_id, thread_id):
+        with self.lock:
+            with self.db:
+                self.db.execute('INSERT OR REPLACE INTO NARRATOR_THREADS (Campaign_ID, Thread_ID) VALUES (?, ?)', (campaign_id, thread_id))
+
+# one character's inventory, loaded once and then kept in sync write-through: the assistant
+# applies each committed obtain/discard here, so snapshots need no SQL
+# version equals the character's INVENTORY_GENERATION, every applied change bumps it by one
+# and is sent to the subscribers as a delta
+# assumes the owning assistant is the only writer of this character's inventory, call load()
+# again after editing the DB (or WORLD_ITEMS) behind its back
+class InventoryState:
+
+    def __init__(self, campaign_id, character_id):
+        self.campaign_id = campaign_id
+        self.character_id = character_id
+        self.version = 0
+        self.__items = {}   # Item_ID -> row dict
+        self.__deltas = collections.deque(maxlen=INVENTORY_DELTA_LOG_SIZE)
+        self.__subscribers = []
+        self.__lock = threading.Lock()
+
+    def load(self, db):
+        key = (self.campaign_id, self.character_id)
+        items = {}
+        for item_id, name, description, quantity in db.execute(LOAD_INVENTORY_SQL, key):
+            items[item_id] = {'Item_ID': item_id, 'Weapon_Name': name, 'Weapon_Description': description, 'Total_Quantity': quantity}
+        generation = db.execute(GET_GENERATION_SQL, key).fetchone()[0]
+        with self.__lock:
+            self.__items = items
+            # deltas from before the reload no longer describe how to reach this state
+            self.__deltas.clear()
+            self.version = generation or 0
+        return self
+
+    def holds(self, item_id):
+        return item_id in self.__items
+
+    # changes: (Item_ID, quantity change, Weapon_Name, Weapon_Description) of one committed step,
+    # name and description are only needed for items not held yet
+    def apply(self, changes):
+        if not changes:
+            return None
+        with self.__lock:
+            rows = []
+            for item_id, change, name, description in changes:
+                item = self.__items.get(item_id)
+                if item is None:
+                    item = self.__items[item_id] = {'Item_ID': item_id, 'Weapon_Name': name, 'Weapon_Description': description, 'Total_Quantity': 0}
+                item['Total_Quantity'] += change
+                # same rule as REMOVE_EMPTY_ITEM_SQL
+                if item['Total_Quantity'] <= 0:
+                    del self.__items[item_id]
+                rows.append({'Item_ID': item_id, 'Weapon_Name': item['Weapon_Name'], 'Quantity_Change': change, 'Total_Quantity': max(item['Total_Quantity'], 0)})
+            self.version += len(changes)
+            delta = {'campaign_id': self.campaign_id, 'character_id': self.character_id, 'version': self.version, 'changes': rows}
+            self.__deltas.append(delta)
+            subscribers = list(self.__subscribers)
+        for callback in subscribers:
+            try:
+                callback(delta)
+            except Exception as e:
+                print("Inventory subscriber failed.")
+                print(repr(e))
+        return delta
+
+    # rows in Item_ID order, copies so callers can't edit the state
+    def snapshot(self):
+        with self.__lock:
+            return [dict(self.__items[item_id]) for item_id in sorted(self.__items)]
+
+    # deltas that bring a client at version up to date, None if the log no longer reaches back
+    # that far and the client has to take a fresh snapshot
+    def changes_since(self, version):
+        with self.__lock:
+            if version >= self.version:
+                return []
+            deltas = [delta for delta in self.__deltas if delta['version'] > version]
+            if not deltas or deltas[0]['version'] - len(deltas[0]['changes']) > version:
+                return None
+            return deltas
+
+    # callback(delta) runs after every applied step, returns a function that unsubscribes
+    def subscribe(self, callback):
+        with self.__lock:
+            self.__subscribers.append(callback)
+        def unsubscribe():
+            with self.__lock:
+                if callback in self.__subscribers:
+                    self.__subscribers.remove(callback)
+        return unsubscribe
+
+# recognizes pure inventory questions and answers them from the in-memory inventory (recent
+# pickups from the history), so they need no run
+# a pattern has to match the whole message, questions about an item are only as confident as
+# the catalog's match of its name
+class InventoryRouter:
+
+    ITEM_WORDS = r"(?:weapons?|items?|things|gear|stuff)"
+    WHERE = r"(?: (?:on me|with me|in total|total|left|now|in my (?:inventory|pack|bag|backpack)))*"
+    INTENTS = [
+        ('count_all', re.compile(rf"how many {ITEM_WORDS} (?:do|did) i (?:have|own|carry|hold|have on me){WHERE}")),
+        ('list', re.compile(
+            rf"what(?: is|'s| do i have) in my (?:inventory|pack|bag|backpack)"
+            rf"|what {ITEM_WORDS} (?:do i have|do i own|am i carrying|am i holding){WHERE}"
+            rf"|(?:(?:can you |please )?(?:list|show|check)(?: me)?|i (?:check|look in|open)) my (?:inventory|pack|bag|backpack|items|weapons|gear)"
+        )),
+        ('recent', re.compile(r"what (?:did i|have i) (?:just |recently )?(?:pick(?:ed)? up|obtain(?:ed)?|get|got|find|found|loot(?:ed)?)(?: recently| last| lately)?")),
+        ('count_item', re.compile(rf"how many (?P<item>.+?)s? (?:do|did) i (?:have|own|carry|hold){WHERE}")),
+        ('has_item', re.compile(rf"(?:do i (?:still )?(?:have|own|carry|hold)|am i (?:still )?(?:carrying|holding)) (?:an? |the |any |my )?(?P<item>.+?){WHERE}")),
+    ]
+
+    def __init__(self, catalog, inventory, readers):
+        self.catalog = catalog
+        self.inventory = inventory
+        self.readers = readers
+
+    @staticmethod
+    def normalize(content):
+        text = re.sub(r"\s+", " ", content.strip().lower())
+        return text.rstrip(" ?!.")
+
+    @staticmethod
+    def __quantity(value):
+        return int(value) if float(value).is_integer() else value
+
+    def __listing(self, items):
+        return ', '.join(f"{self.__quantity(item['Total_Quantity'])} {item['Weapon_Name']}" for item in items)
+
+    # (intent, answer, confidence), or None when the message is not a pure inventory question
+    def route(self, content):
+        text = self.normalize(content)
+        for intent, pattern in self.INTENTS:
+            match = pattern.fullmatch(text)
+            if match is None:
+                continue
+            if 'item' not in pattern.groupindex:
+                return intent, getattr(self, f'_InventoryRouter__answer_{intent}')(), 1.0
+            candidates = self.catalog.candidates(match.group('item'), limit=2)
+            if not candidates:
+                return None
+            resolved = self.catalog.resolve(match.group('item'))
+            # an ambiguous name is never confident enough, the model can ask which one is meant
+            confidence = candidates[0][2] if resolved is not None else candidates[0][2] / 2
+            return intent, getattr(self, f'_InventoryRouter__answer_{intent}')(candidates[0]), confidence
+        return None
+
+    def __answer_count_all(self):
+        items = self.inventory.snapshot()
+        if not items:
+            return "You are not carrying any weapons."
+        total = self.__quantity(sum(item['Total_Quantity'] for item in items))
+        return f"You are carrying {total} weapon{'s' if total != 1 else ''} in total: {self.__listing(items)}."
+
+    def __answer_list(self):
+        items = self.inventory.snapshot()
+        if not items:
+            return "Your pack is empty."
+        return f"In your pack: {self.__listing(items)}."
+
+    def __answer_recent(self):
+        key = (self.inventory.campaign_id, self.inventory.character_id)
+        with self.readers.connection() as db:
+            rows = db.execute(RECENT_PICKUPS_SQL, (*key, RECENT_PICKUPS)).fetchall()
+        if not rows:
+            return "You have not picked anything up recently."
+        return "Most recently you picked up: " + ', '.join(f"{self.__quantity(quantity)} {name}" for name, quantity in rows) + "."
+
+    def __held(self, candidate):
+        item_id, name, _ = candidate
+        for item in self.inventory.snapshot():
+            if item['Item_ID'] == item_id:
+                return name, self.__quantity(item['Total_Quantity'])
+        return name, 0
+
+    def __answer_count_item(self, candidate):
+        name, quantity = self.__held(candidate)
+        if not quantity:
+            return f"You do not have any {name}."
+        return f"You have {quantity} {name}."
+
+    def __answer_has_item(self, candidate):
+        name, quantity = self.__held(candidate)
+        if not quantity:
+            return f"No, you do not have any {name}."
+        return f"Yes, you have {quantity} {name}."
+
+# keeps the narrator's context window small: decides when the thread has to be rotated, stores
+# the summaries of rotated threads as LOGS events and PLOT rows, builds the seed of the next
+# thread and retrieves the stored events relevant to a turn
+# DB side only, the assistants make the API calls
+class CampaignMemory:
+
+    def __init__(self, db, lock, readers, campaign_id, character_id, token_budget=CONTEXT_TOKEN_BUDGET):
+        self.db = db
+        self.lock = lock
+        self.readers = readers
+        self.campaign_id = campaign_id
+        self.character_id = character_id
+        self.token_budget = token_budget
+        # sent with every run whatever the thread holds
+        self.fixed_tokens = self.estimate_tokens(NARRATOR_INSTRUCTIONS + json.dumps(NARRATOR_TOOLS))
+        with self.lock:
+            self.searchable = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'LOGS_SEARCH'").fetchone() is not None
+
+    @staticmethod
+    def estimate_tokens(text):
+        return len(text) // TOKEN_CHARS + 1
+
+    # whether the next turn's prompt could go over the budget on the current thread
+    def needs_rotation(self, history, content):
+        if len(history) <= KEEP_RECENT_MESSAGES:
+            return False
+        tokens = self.fixed_tokens + history.characters // TOKEN_CHARS + self.estimate_tokens(content) + RETRIEVAL_TOKEN_BUDGET
+        return tokens > self.token_budget
+
+    # chat.completions messages summarizing everything but the messages carried over
+    def summary_messages(self, history):
+        entries = list(history.view())[::-1][:-KEEP_RECENT_MESSAGES]
+        transcript = '\n'.join(f"{entry['role']}: {' '.join(entry['content'].split())}" for entry in entries)
+        return [
+            {'role': 'system', 'content': SUMMARY_INSTRUCTIONS},
+            {'role': 'user', 'content': transcript},
+        ]
+
+    # store the model's summary, a reply that is not the requested JSON is kept as the summary
+    def record_summary(self, reply):
+        try:
+            parsed = json.loads(reply)
+            summary = str(parsed['summary'])
+            events = [str(event) for event in parsed.get('events', []) if str(event).strip()]
+        except (ValueError, TypeError, KeyError):
+            summary, events = reply.strip(), []
+        with self.lock:
+            with self.db:
+                self.db.executemany(RECORD_EVENT_SQL, [(event, self.campaign_id, self.character_id) for event in events])
+                self.db.execute(RECORD_SUMMARY_SQL, (summary, '\n'.join(events), self.campaign_id))
+        return summary
+
+    # first messages of the next thread: the summary and inventory, then the carried over messages
+    def seed_messages(self, summary, inventory, history):
+        listing = ', '.join(f"{item['Total_Quantity']:g} {item['Weapon_Name']}" for item in inventory) or 'nothing'
+        seed = [{'role': 'assistant', 'content': f"The story so far: {summary}\n\nThe character is carrying: {listing}."}]
+        for entry in list(history.view())[KEEP_RECENT_MESSAGES - 1::-1]:
+            seed.append({'role': entry['role'], 'content': entry['content']})
+        return seed
+
+    # the stored events most relevant to content, within RETRIEVAL_TOKEN_BUDGET, as additional
+    # instructions for the run, None when there are none
+    def retrieve(self, content):
+        words = []
+        for word in re.findall(r"[a-z0-9]{3,}", content.lower()):
+            if word not in SEARCH_STOPWORDS and word not in words:
+                words.append(word)
+        with self.readers.connection() as db:
+            if self.searchable and words:
+                query = ' OR '.join(f'"{word}"' for word in words)
+                rows = db.execute(SEARCH_EVENTS_SQL, (query, self.campaign_id, RETRIEVED_EVENTS)).fetchall()
+            else:
+                rows = db.execute(RECENT_EVENTS_SQL, (self.campaign_id, RETRIEVED_EVENTS)).fetchall()
+        lines = []
+        room = RETRIEVAL_TOKEN_BUDGET
+        for time_stamp, event in rows:
+            line = f"- [{time_stamp}] {event}"
+            room -= self.estimate_tokens(line)
+            if room < 0:
+                break
+            lines.append(line)
+        if not lines:
+            return None
+        return 'Relevant events from earlier in this campaign:\n' + '\n'.join(lines)
+
+# one SQLite file per campaign for its mutable state, so writers of different campaigns never
+# wait on the same file lock, plus one world DB with the static sheets (WORLD_TABLES) that every
+# campaign connection ATTACHes read-only and memory-mapped
+# both are cut from the workbook's template DB: the world once per workbook, every new campaign
+# file is cloned from a campaign template without the world tables
+# the directory DB maps campaign IDs to files and holds the narrator assistants all campaigns share
+class ShardRouter:
+
+    def __init__(self, shard_dir, excel_db_filename):
+        self.shard_dir = os.path.abspath(shard_dir)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        template_name = LLDM_Assistant._get_template_db(excel_db_filename)
+        # keyed like the template, a changed workbook gets new files and an immutable world stays valid
+        key = pathlib.Path(template_name).stem
+        self.world_name = self.__cut_template(template_name, f'world-{key}.db', world=True)
+        self.campaign_template = self.__cut_template(template_name, f'campaign-template-{key}.db', world=False)
+        self.world_uri = pathlib.Path(self.world_name).as_uri() + '?mode=ro&immutable=1'
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(self.shard_dir, SHARD_DIRECTORY_DB), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SHARD_DIRECTORY_SCHEMA)
+
+    # copy of the template with either only the world tables or everything else, views are
+    # dropped from both since they join across the two
+    def __cut_template(self, template_name, file_name, world):
+        db_name = os.path.join(self.shard_dir, file_name)
+        if os.path.exists(db_name):
+            return db_name
+
+        fd, tmp_name = tempfile.mkstemp(suffix='.db', dir=self.shard_dir)
+        os.close(fd)
+        try:
+            db = sqlite3.connect(tmp_name)
+            try:
+                template = sqlite3.connect(pathlib.Path(template_name).resolve().as_uri() + '?mode=ro', uri=True)
+                try:
+                    template.backup(db)
+                finally:
+                    template.close()
+                objects = db.execute("SELECT type, name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite%'").fetchall()
+                for kind, name in objects:
+                    if kind == 'view' or (name in WORLD_TABLES) != world:
+                        db.execute(f'DROP {kind.upper()} IF EXISTS "{name}"')
+                # a single file, so the world can be opened immutable and campaigns cloned by copy
+                db.execute('PRAGMA journal_mode = DELETE')
+                db.execute('VACUUM')
+            finally:
+                db.close()
+            # atomic, a concurrent builder of the same template produces an identical file
+            os.replace(tmp_name, db_name)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+        return db_name
+
+    # file of a campaign, a new campaign gets a fresh clone of the campaign template
+    def shard_path(self, campaign_id):
+        with self.lock:
+            row = self.db.execute('SELECT File_Name FROM CAMPAIGN_SHARDS WHERE Campaign_ID = ?', (campaign_id,)).fetchone()
+            if row is not None:
+                return os.path.join(self.shard_dir, row[0])
+
+            file_name = f'campaign-{campaign_id}.db'
+            db_name = os.path.join(self.shard_dir, file_name)
+            if not os.path.exists(db_name):
+                fd, tmp_name = tempfile.mkstemp(suffix='.db', dir=self.shard_dir)
+                os.close(fd)
+                try:
+                    shutil.copyfile(self.campaign_template, tmp_name)
+                    # link fails if another process created the campaign meanwhile, keep theirs
+                    os.link(tmp_name, db_name)
+                except FileExistsError:
+                    pass
+                finally:
+                    os.remove(tmp_name)
+            with self.db:
+                self.db.execute('INSERT OR IGNORE INTO CAMPAIGN_SHARDS (Campaign_ID, File_Name) VALUES (?, ?)', (campaign_id, file_name))
+            return os.path.join(self.shard_dir, self.db.execute('SELECT File_Name FROM CAMPAIGN_SHARDS WHERE Campaign_ID = ?', (campaign_id,)).fetchone()[0])
+
+    def campaigns(self):
+        with self.lock:
+            return dict(self.db.execute('SELECT Campaign_ID, File_Name FROM CAMPAIGN_SHARDS ORDER BY Campaign_ID'))
+
+    # attach the world to a campaign connection and add the views the model queries, the
+    # connection must have been opened with uri=True
+    def attach(self, db):
+        db.execute('ATTACH DATABASE ? AS world', (self.world_uri,))
+        db.execute(f'PRAGMA world.mmap_size = {WORLD_MMAP_SIZE}')
+        db.executescript(TEMP_INVENTORY_VIEWS)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
 
 class LLDM_Assistant:
 
@@ -14,228 +1661,511 @@ class LLDM_Assistant:
     class ItemNotPossessedException(Exception):
         pass
 
-    def __init__(self, api_key, db_name, excel_db_filename=None):
-        self.client = OpenAI(api_key=api_key)
-        if excel_db_filename:
-            self.db = self.__create_db_from_file(excel_db_filename, db_name)
-        else:
-            self.db = self.__connect_to_existing_db(db_name)
-
-        get_info_func_desc = '''
-        Generate a SQL query to help extract the information that the user is asking for with regards to the items in their character's inventory, such as taking out or utilizing an item the character possesses. Use the following view to help generate the query, with the description of each column in between asterisks (*):
-
-        CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_DETAILS (
-            Weapon_Name text, 
-            Weapon_Description text ,
-            Total_Quantity int    
-        );
-
-        CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_DETAILS (
-            Weapon_Name text, 
-            Weapon_Description text,
-            Quantity int *A positive number represents obtained weapons, while a negative number means discarded*,
-            Modify_Time datetime
-        );
-
-        Make sure to only query columns that exist from each table. Do not switch column-table identities.
-        Only return the SQL query without any preamble or post text, as well as without any quotes. Do not add a semicolon at the end of the query
-        Only create SELECT queries and do not create any queries that will modify the table in any way.
-        '''
-        
-        self.narrator = self.client.beta.assistants.create(
-            name="narrator",
-            instructions=
-                """
-                You are a DnD DM. You sets the scene by describing the environment and atmosphere, brings NPCs to life through detailed character portrayals, and narrates the outcomes of player actions. They establish the game's tone, provide world-building lore, guide the overarching story while balancing player choices, and enforce game rules.
-
-                The information of the main character is as follows: Elara Windrider, a courageous warrior with a heart of gold, is a human fighter who embodies the principles of Lawful Good. She is tall and athletic, with short brown hair, green eyes, and a determined expression. Clad in chain mail and wielding a longsword, Elara's appearance reflects her readiness for battle. Born in a small village, she was trained by her father, a retired soldier. Driven by a desire to protect the innocent and seek justice, she left home to make her mark on the world. Elara is brave and compassionate, possessing a strong sense of justice. Though she is determined and reliable, her stubbornness can sometimes get the best of her.
-
-                The plot summary is as follows:
-
-                    The Dragon's Flagon (Tavern)
-                Description: The Dragon's Flagon is a lively tavern with a warm, welcoming atmosphere. The walls are adorned with trophies from past adventurers, and a large fireplace dominates one side of the room.
-                
-                    Whispering Woods (Wilderness)
-                Description: Whispering Woods is a foreboding forest with a canopy so thick it blocks out most of the sunlight. The air is filled with the sounds of unseen creatures, and the ground is covered with a thick layer of leaves.
-                
-                Description: Blackstone Keep is a crumbling fortress with tall, dark towers and walls covered in ivy. Inside, it is dark and cold, with the air thick with the smell of decay.
-
-                After receiving user response, you generate a narrative that moves the plot forward while maintaining a realistic continuity of events.
-                """,
-
-            tools=[
-                # {"type": "file_search"},
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "get_obtained_item",
-                        "description": "Extract the item that the user has obtained in some manner (such as picked up, purchased, etc.). This does not include utilizing an item that the user currently might have in their inventory.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "item_name": {
-                                    "type": "string",
-                                    "description": "The name of the obtained item.",
-                                },
-                                "quantity": {
-                                    "type": "integer",
-                                    "description": "The number of said items obtained. If a number is not specified, try and infer based on the surrounding context."
-                                }
-                            },
-                            "required": ["item_name", "quantity"],
-                        },
-                    },
-                },
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "get_discarded_item",
-                        "description": "Extract the item that the user has discarded in some manner (such as thrown away, consumed, broken, etc.)",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "item_name": {
-                                    "type": "string",
-                                    "description": "The name of the discarded item.",
-                                },
-                                "quantity": {
-                                    "type": "integer",
-                                    "description": "The number of said items discarded. If a number is not specified, try and infer based on the surrounding context."
-                                }
-                            },
-                            "required": ["item_name", "quantity"],
-                        },
-                    },
-                },
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "get_item_info",
-                        "description": get_info_func_desc,
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "sql_query": {
-                                    "type": "string",
-                                    "description": "The generated SQL query that would extract the information related to the character inventory requested by the user",
-                                }
-                            },
-                            "required": ["sql_query"],
-                        },
-                    },
-                }
-            ],
-            model="gpt-3.5-turbo",
-        )
+    _read_executor = None
+    _query_rewrites = LRUCache(QUERY_REWRITE_CACHE_SIZE)
+
+    # client is anything exposing the OpenAI().beta assistants/threads surface, e.g.
+    # fake_openai.FakeOpenAI for offline runs and benchmarks
+    # pass a Tracer to get spans and metrics for every turn, tool call and DB query
+    # with fast_path, pure inventory questions are answered locally when the router is at least
+    # fast_path_threshold confident, see InventoryRouter
+    # context_budget is the token budget of a turn's prompt, see CampaignMemory, None lets the
+    # thread grow
+    # with a ShardRouter as shards the campaign is stored in its own file and db_name is ignored
+    # assistants given the same ConnectionPool share its writer and readers, the pool has to be
+    # for the same DB file (shard) every time
+    def __init__(self, api_key, db_name, excel_db_filename=None, use_streaming=True, campaign_id=0, character_id=0, client=None, tracer=None, fast_path=False, fast_path_threshold=FAST_PATH_CONFIDENCE, context_budget=CONTEXT_TOKEN_BUDGET, shards=None, pool=None):
+        self.client = client or OpenAI(api_key=api_key)
+        self.shards = shards
+        self.pool = pool
+        self.context_budget = context_budget
+        self.tracer = tracer or NULL_TRACER
+        self.last_trace_id = None
+        self.fast_path = fast_path
+        self.fast_path_threshold = fast_path_threshold
+        self.use_streaming = use_streaming
+        self.campaign_id = campaign_id
+        self.character_id = character_id
+        self.last_turn_timings = {}
+        self._open_db(db_name, excel_db_filename)
+
+        # reuse the narrator and this campaign's thread from the registry, creating them only
+        # on first use or when the narrator configuration changed
+        self.narrator_id = self.registry.assistant_id(NARRATOR_CONFIG_HASH)
+        if self.narrator_id is None:
+            self.narrator_id = self.client.beta.assistants.create(**NARRATOR_CONFIG).id
+            for stale_id in self.registry.save_assistant(NARRATOR_CONFIG_HASH, self.narrator_id):
+                self.__delete_assistant(stale_id)
+
+        self.thread_id = self.registry.thread_id(self.campaign_id)
+        if self.thread_id is None:
+            self.thread_id = self.client.beta.threads.create().id
+            self.registry.save_thread(self.campaign_id, self.thread_id)
+        self.history = ChatHistory(self.thread_id)
+
+    def __delete_assistant(self, assistant_id):
+        try:
+            self.client.beta.assistants.delete(assistant_id)
+            print(f"Deleted outdated assistant {assistant_id}.")
+        except Exception as e:
+            print(f"Could not delete outdated assistant {assistant_id}.")
+            print(repr(e))
 
-        self.thread_narrator = self.client.beta.threads.create()
+    # shared by the sync and async assistants, the connection may be used from executor threads
+    # (and other assistants of the pool) so every access goes through db_lock
+    # excel_db_filename only applies when this assistant is the one connecting the pool
+    def _open_db(self, db_name, excel_db_filename=None):
+        if self.shards is not None:
+            db_name = self.shards.shard_path(self.campaign_id)
+        pool = self.pool or ConnectionPool()
+        with pool.lock:
+            if pool.db is None:
+                if excel_db_filename:
+                    pool.db = self.__create_db_from_file(excel_db_filename, db_name)
+                else:
+                    pool.db = self.__connect_to_existing_db(db_name)
+                if self.shards is not None:
+                    self.shards.attach(pool.db)
+                    pool.readers = ReaderPool(db_name, pool.max_readers, setup=self.shards.attach)
+                else:
+                    pool.readers = ReaderPool(db_name, pool.max_readers)
+                pool.catalog = ItemCatalog(pool.db, pool.lock)
+        self.db_lock = pool.lock
+        self.db = pool.db
+        self.readers = pool.readers
+        self.catalog = pool.catalog
+        if self.shards is not None:
+            self.registry = AssistantRegistry(self.db, self.db_lock, self.shards.db, self.shards.lock)
+        else:
+            self.registry = AssistantRegistry(self.db, self.db_lock)
+        self.query_results = LRUCache(QUERY_RESULT_CACHE_SIZE)
+        self.query_guard = QueryGuard()
+        self.result_encoder = ResultEncoder()
+        with self.db_lock:
+            self.inventory = InventoryState(self.campaign_id, self.character_id).load(self.db)
+            checkpoint = self.db.execute(LAST_CHECKPOINT_SQL, (self.campaign_id, self.character_id)).fetchone()
+        self.router = InventoryRouter(self.catalog, self.inventory, self.readers)
+        self.memory = None
+        if self.context_budget is not None:
+            self.memory = CampaignMemory(self.db, self.db_lock, self.readers, self.campaign_id, self.character_id, self.context_budget)
+        # generation of the session character's newest checkpoint
+        self._checkpoint_generation = checkpoint[2] if checkpoint else 0
+        # inventory changes of the step in progress, applied to self.inventory once it commits
+        self._pending_inventory = []
+
+    # bring any lldm.db up to SCHEMA_VERSION, files from before the inventory keys existed get
+    # their duplicate rows merged first
+    # a campaign shard (world=False) has no world tables, the catalog triggers and views are
+    # left to the world DB and ShardRouter.attach
+    @staticmethod
+    def __migrate_db(db, world=True):
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        tables = {name for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if version < 1 and 'CHARACTER_INVENTORY' in tables:
+            print("Migrating inventory tables to keyed schema.")
+            db.executescript(INVENTORY_KEYS_MIGRATION)
+        if version < 4 and 'CHARACTER_INVENTORY_HISTORY' in tables:
+            history_sql = db.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'CHARACTER_INVENTORY_HISTORY'").fetchone()[0]
+            if 'AUTOINCREMENT' not in history_sql:
+                db.executescript(HISTORY_AUTOINCREMENT_MIGRATION)
+        db.executescript(INVENTORY_SCHEMA)
+        db.executescript(REGISTRY_SCHEMA)
+        db.executescript(HISTORY_COMPACTION_SCHEMA)
+        if world:
+            db.executescript(CATALOG_VERSION_SCRIPT)
+            db.executescript(INVENTORY_VIEWS)
+        # LOGS/PLOT sheets from before the campaign columns existed
+        for table, columns in (('LOGS', ('Campaign_ID', 'Character_ID')), ('PLOT', ('Campaign_ID',))):
+            existing = {row[1] for row in db.execute(f'PRAGMA table_info("{table}")')}
+            for column in columns:
+                if existing and column not in existing:
+                    db.execute(f'ALTER TABLE "{table}" ADD COLUMN {column} INTEGER')
+        db.executescript(MEMORY_SCHEMA)
+        if 'LOGS_SEARCH' not in tables:
+            try:
+                db.executescript(LOGS_SEARCH_SCHEMA)
+                db.execute("INSERT INTO LOGS_SEARCH (LOGS_SEARCH) VALUES ('rebuild')")
+            except sqlite3.OperationalError as e:
+                print("Event search is not available, retrieving the latest events instead.")
+                print(repr(e))
+        db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        # the search index rebuild above opened a transaction
+        db.commit()
 
-    def narrator_chat(self, content):
+    # WAL lets the read-only connections run next to the writer, and with synchronous=NORMAL
+    # a commit does not fsync on its own
+    def __configure_connection(self, db):
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+
+    @staticmethod
+    def __get_read_executor():
+        if LLDM_Assistant._read_executor is None:
+            LLDM_Assistant._read_executor = ThreadPoolExecutor(max_workers=READ_EXECUTOR_WORKERS, thread_name_prefix='lldm-read')
+        return LLDM_Assistant._read_executor
+
+    # returns the whole history newest first, or only this turn's new messages with new_only
+    def narrator_chat(self, content, new_only=False):
+        # one trace per turn, every phase, tool call and query below is a span of it
+        with self.tracer.span('narrator_chat', campaign_id=self.campaign_id, character_id=self.character_id, thread_id=self.thread_id) as span:
+            self.last_trace_id = span.trace_id
+            self.tracer.increment('lldm_turns_total')
+            if self.fast_path:
+                routed = self.router.route(content)
+                if routed is not None and routed[2] >= self.fast_path_threshold:
+                    span.set(fast_path=routed[0])
+                    self.tracer.increment('lldm_fast_path_total', intent=routed[0])
+                    return self.__fast_path_turn(content, routed[1], new_only)
+            return self.__chat_turn(content, new_only)
+
+    # the question and the local answer still go into the thread, so the narrator sees them
+    def __fast_path_turn(self, content, answer, new_only):
+        print('Answering from the inventory...')
+        timings = {}
+        start = time.perf_counter()
+        self.client.beta.threads.messages.create(
+            thread_id=self.thread_id,
+            role="user",
+            content=f"""
+            {content}
+            """,
+        )
+        self.client.beta.threads.messages.create(thread_id=self.thread_id, role="assistant", content=answer)
+        _add_timing(self.tracer, timings, 'message_create', start)
+
+        start = time.perf_counter()
+        new_messages = self.__fetch_new_messages()
+        _add_timing(self.tracer, timings, 'history_list', start)
+
+        self.last_turn_timings = timings
+        _report_timings(timings)
+        if new_only:
+            return new_messages[::-1]
+        return self.history.view()
+
+    def __chat_turn(self, content, new_only):
+        # seconds spent in each phase of this turn, reported once the run finishes
+        timings = {}
+        run_options = {}
+        if self.memory is not None:
+            if self.memory.needs_rotation(self.history, content):
+                self.__rotate_thread(timings)
+            start = time.perf_counter()
+            events = self.memory.retrieve(content)
+            if events is not None:
+                run_options['additional_instructions'] = events
+            _add_timing(self.tracer, timings, 'retrieve', start)
+
+        start = time.perf_counter()
         message = self.client.beta.threads.messages.create(
-            thread_id=self.thread_narrator.id,
+            thread_id=self.thread_id,
             role="user",
             content=f"""
             {content}
             """,
         )
+        _add_timing(self.tracer, timings, 'message_create', start)
 
-        run = self.client.beta.threads.runs.create_and_poll(
-            thread_id=self.thread_narrator.id,
-            assistant_id=self.narrator.id,
+        if self.use_streaming and hasattr(self.client.beta.threads.runs, 'stream'):
+            run = self.__stream_run(timings, run_options)
+        else:
+            run = self.__poll_run(timings, run_options)
+
+        start = time.perf_counter()
+        new_messages = self.__fetch_new_messages()
+        _add_timing(self.tracer, timings, 'history_list', start)
+
+        self.last_turn_timings = timings
+        _report_timings(timings)
+        if new_only:
+            return new_messages[::-1]
+        return self.history.view()
+
+    # summarize the thread into the campaign memory and continue on a new thread seeded with the
+    # summary, the inventory and the last few messages
+    def __rotate_thread(self, timings):
+        start = time.perf_counter()
+        try:
+            completion = self.client.chat.completions.create(model=SUMMARY_MODEL, messages=self.memory.summary_messages(self.history))
+        except Exception as e:
+            # the turn still runs, on the long thread
+            print("Could not summarize the campaign thread.")
+            print(repr(e))
+            return
+        summary = self.memory.record_summary(completion.choices[0].message.content)
+        seed = self.memory.seed_messages(summary, self.inventory.snapshot(), self.history)
+        thread_id = self.client.beta.threads.create(messages=seed).id
+        self.registry.save_thread(self.campaign_id, thread_id)
+        print(f"Continuing campaign {self.campaign_id} on thread {thread_id}.")
+        self.thread_id = thread_id
+        self.history = ChatHistory(thread_id)
+        _add_timing(self.tracer, timings, 'rotate_thread', start)
+
+    def __fetch_new_messages(self):
+        new_messages = []
+        has_more = True
+        while has_more:
+            page = self.client.beta.threads.messages.list(**self.history.list_params())
+            entries, has_more = self.history.extend(page)
+            new_messages.extend(entries)
+        return new_messages
+
+    # drive the run with the Assistants streaming events, handling requires_action
+    # as soon as it arrives and returning on the first terminal event
+    def __stream_run(self, timings, run_options):
+        runs = self.client.beta.threads.runs
+        manager = runs.stream(
+            thread_id=self.thread_id,
+            assistant_id=self.narrator_id,
+            **run_options,
+        )
+        run = None
+        while manager is not None:
+            start = time.perf_counter()
+            with manager as stream:
+                manager = None
+                for event in stream:
+                    if event.event == 'thread.run.requires_action':
+                        _add_timing(self.tracer, timings, 'run_wait', start)
+                        run = event.data
+                        tool_outputs = self.__dispatch_tool_calls(run, timings)
+                        print("Submitting outputs back to the Assistant…")
+                        # the request is only sent when the next iteration enters the manager
+                        manager = runs.submit_tool_outputs_stream(
+                            thread_id=self.thread_id,
+                            run_id=run.id,
+                            tool_outputs=tool_outputs
+                        )
+                        break
+                    if event.event in RUN_TERMINAL_EVENTS:
+                        _add_timing(self.tracer, timings, 'run_wait', start)
+                        run = event.data
+            _report_run_status(run)
+        return run
+
+    # fallback driver, polls with adaptive backoff instead of a fixed sleep
+    def __poll_run(self, timings, run_options):
+        runs = self.client.beta.threads.runs
+        start = time.perf_counter()
+        run = runs.create(
+            thread_id=self.thread_id,
+            assistant_id=self.narrator_id,
+            **run_options,
         )
+        _add_timing(self.tracer, timings, 'run_create', start)
 
-        counter = 0
-        while run.status != 'completed':
-            # print(run.status)
+        delay = POLL_MIN_INTERVAL
+        while run.status not in RUN_TERMINAL_STATUSES:
             if run.status == 'requires_action':
-                print('Function calling...')
-                required_actions = run.required_action.submit_tool_outputs.model_dump()
-                tool_outputs = []
-                # print(required_actions["tool_calls"])
-                for action in required_actions["tool_calls"]:
-                    func_name = action['function']['name']
-                    arguments = json.loads(action['function']['arguments'])
-                    available_functions = {
-                        "get_obtained_item": self.__get_obtained_item,
-                        "get_discarded_item": self.__get_discarded_item,
-                        'get_item_info': self.__get_item_info
-                    }
-                    try:
-                        function_to_call = available_functions[func_name]
-                        # print(arguments)
-                        # function_args = json.loads(arguments)
-                        # output = function_to_call(
-                        #     item_name=function_args.get("item_name"),
-                        #     quantity=function_args.get("quantity"),
-                        # )
-                        output = function_to_call(
-                            **arguments
-                        )
-                        output_string = json.dumps(output)
-                        # print(output_string)
-                        tool_outputs.append({
-                            "tool_call_id": action['id'],
-                            "output": output_string
-                        })
-                    except: # function not found
-                        raise ValueError(f"Unknown function: {func_name}")
-                    
+                tool_outputs = self.__dispatch_tool_calls(run, timings)
                 print("Submitting outputs back to the Assistant…")
-                # print(run.status)
-                run = self.client.beta.threads.runs.submit_tool_outputs(
-                    thread_id=self.thread_narrator.id,
+                start = time.perf_counter()
+                run = runs.submit_tool_outputs(
+                    thread_id=self.thread_id,
                     run_id=run.id,
                     tool_outputs=tool_outputs
                 )
-                # time.sleep(5) 
-            if run.status == "cancelled":
-                print("Run cancelled.")
-                break
+                _add_timing(self.tracer, timings, 'submit', start)
+                # the model picks up right away after a submit, so check back quickly
+                delay = POLL_MIN_INTERVAL
+                continue
             if run.status == "cancelling":
                 print("Run cancelling.")
-            if run.status == "failed":
-                print("Run failed.")
-                break
-            if run.status == "expired":
-                print("Run expired.")
-                break
-            else:            
-                run = self.client.beta.threads.runs.retrieve(
-                    thread_id=self.thread_narrator.id,
-                    run_id=run.id,
-                )
-                time.sleep(5)  
-                # if counter % 10 == 0:
-                #     # print('Waiting for assistant. Status:', run.status)
-                #     counter += 1
-                #     time.sleep(5)  
-                
-            
-        
-        messages_narrator = self.client.beta.threads.messages.list(
-            thread_id=self.thread_narrator.id
-        )
-        chat_history_narrator = []
-        for thread_message in messages_narrator.data:
-            for content_item in thread_message.content:
-                role = thread_message.role
-                id = thread_message.assistant_id
-                item = content_item.text.value
-                chat_history_narrator.append({'role': role, 'content': item})
-
-        return chat_history_narrator
 
+            start = time.perf_counter()
+            time.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            run = runs.retrieve(
+                thread_id=self.thread_id,
+                run_id=run.id,
+            )
+            _add_timing(self.tracer, timings, 'poll', start)
+
+        _report_run_status(run)
+        return run
+
+    def __dispatch_tool_calls(self, run, timings):
+        print('Function calling...')
+        start = time.perf_counter()
+        tool_outputs = self._run_tool_calls(run.required_action.submit_tool_outputs.tool_calls)
+        _add_timing(self.tracer, timings, 'tool_calls', start)
+        return tool_outputs
+
+    # run every tool call of a requires_action step and collect the outputs to submit
+    # blocking DB work, the async assistant runs it in its executor
+    def _run_tool_calls(self, tool_calls):
+        available_functions = {
+            "get_obtained_item": self.__get_obtained_item,
+            "get_discarded_item": self.__get_discarded_item,
+            'get_item_info': self.__get_item_info
+        }
+        calls = []
+        for tool_call in tool_calls:
+            func_name = tool_call.function.name
+            if func_name not in available_functions:
+                raise ValueError(f"Unknown function: {func_name}")
+            arguments = json.loads(tool_call.function.arguments)
+            # the model only fills in the schema arguments, the session decides whose inventory it is
+            arguments.update(campaign_id=self.campaign_id, character_id=self.character_id)
+            calls.append((func_name, arguments))
+        outputs = [None] * len(calls)
+
+        # all inventory mutations of the step commit as one group, so a multi-item pickup
+        # costs one commit and a failure rolls back every change of the step
+        mutations = [i for i, (func_name, _) in enumerate(calls) if func_name in MUTATING_TOOLS]
+        if mutations:
+            with self.db_lock:
+                self._pending_inventory = []
+                self.db.execute('BEGIN IMMEDIATE')
+                try:
+                    for i in mutations:
+                        func_name, arguments = calls[i]
+                        outputs[i] = self.__call_tool(available_functions[func_name], func_name, arguments)
+                    # periodic checkpoint, part of the same commit so it matches the step's totals
+                    generation = self.inventory.version + len(self._pending_inventory)
+                    if generation - self._checkpoint_generation >= CHECKPOINT_INTERVAL:
+                        self.__write_checkpoint(self.db.cursor(), self.campaign_id, self.character_id)
+                        self._checkpoint_generation = generation
+                    self.db.commit()
+                except BaseException:
+                    self.db.rollback()
+                    self._pending_inventory = []
+                    raise
+                self.inventory.apply(self._pending_inventory)
+                self._pending_inventory = []
+
+        # read-only calls run after the mutations so they see this step's changes
+        reads = [i for i, (func_name, _) in enumerate(calls) if func_name not in MUTATING_TOOLS]
+        if len(reads) == 1:
+            func_name, arguments = calls[reads[0]]
+            outputs[reads[0]] = self.__call_tool(available_functions[func_name], func_name, arguments)
+        elif reads:
+            # a context copy per call, so each worker's spans join the current trace
+            contexts = [contextvars.copy_context() for _ in reads]
+            results = self.__get_read_executor().map(
+                lambda i, context: context.run(self.__call_tool, available_functions[calls[i][0]], *calls[i]), reads, contexts
+            )
+            for i, output in zip(reads, results):
+                outputs[i] = output
+
+        tool_outputs = []
+        for tool_call, output in zip(tool_calls, outputs):
+            tool_outputs.append({
+                "tool_call_id": tool_call.id,
+                # already encoded by result_encoder
+                "output": output
+            })
+        return tool_outputs
+
+    def __call_tool(self, function, func_name, arguments):
+        with self.tracer.span('tool_call', function=func_name):
+            try:
+                output = function(**arguments)
+            except BaseException:
+                self.tracer.increment('lldm_tool_calls_total', function=func_name, status='error')
+                raise
+        self.tracer.increment('lldm_tool_calls_total', function=func_name, status='ok')
+        return output
+
+    # move raw history older than hot_days to the archive and roll it up per play session,
+    # every character with archived rows is checkpointed first so its inventory can still
+    # be rebuilt from the checkpoint and the rows kept hot
+    def compact_history(self, hot_days=HISTORY_HOT_DAYS):
+        with self.db_lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = self.db.cursor()
+                # same format as the CURRENT_TIMESTAMP defaults of Modify_Time
+                cutoff = self.__execute(cursor, "SELECT datetime('now', ?)", (f'-{hot_days} days',)).fetchone()[0]
+                rows = self.__execute(cursor, '''
+                SELECT History_ID, Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time
+                FROM CHARACTER_INVENTORY_HISTORY WHERE Modify_Time < ?
+                ORDER BY Campaign_ID, Character_ID, History_ID
+                ''', (cutoff,)).fetchall()
+
+                sessions = []
+                for (campaign_id, character_id), changes in itertools.groupby(rows, key=lambda row: (row[1], row[2])):
+                    self.__write_checkpoint(cursor, campaign_id, character_id)
+                    if (campaign_id, character_id) == (self.campaign_id, self.character_id):
+                        self._checkpoint_generation = self.inventory.version
+                    session = None
+                    for _, _, _, item_id, quantity, modify_time in changes:
+                        time_stamp = datetime.datetime.fromisoformat(modify_time)
+                        if session is None or time_stamp - session['end'] > ROLLUP_SESSION_GAP:
+                            session = {'campaign_id': campaign_id, 'character_id': character_id, 'start': time_stamp, 'end': time_stamp, 'items': {}}
+                            sessions.append(session)
+                        session['end'] = time_stamp
+                        total = session['items'].setdefault(item_id, [0, 0])
+                        total[0] += quantity
+                        total[1] += 1
+
+                cursor.executemany(ROLLUP_SQL, [
+                    (session['campaign_id'], session['character_id'], str(session['start']), item_id, str(session['end']), quantity, count)
+                    for session in sessions for item_id, (quantity, count) in session['items'].items()
+                ])
+                if rows:
+                    self.__execute(cursor, '''
+                    INSERT INTO CHARACTER_INVENTORY_HISTORY_ARCHIVE (History_ID, Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time)
+                    SELECT History_ID, Campaign_ID, Character_ID, Item_ID, Quantity, Modify_Time
+                    FROM CHARACTER_INVENTORY_HISTORY WHERE Modify_Time < ?
+                    ''', (cutoff,))
+                    self.__execute(cursor, 'DELETE FROM CHARACTER_INVENTORY_HISTORY WHERE Modify_Time < ?', (cutoff,))
+                    self.__execute(cursor, 'UPDATE HISTORY_VERSION SET Version = Version + 1')
+                self.__execute(cursor, PRUNE_CHECKPOINTS_SQL, (CHECKPOINTS_KEPT,))
+                self.__execute(cursor, PRUNE_CHECKPOINT_ITEMS_SQL)
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        print(f"Archived {len(rows)} inventory history rows into {len(sessions)} session rollups.")
+        return {'archived_rows': len(rows), 'sessions': len(sessions)}
+
+    # recompute a character's CHARACTER_INVENTORY rows from its newest checkpoint and the
+    # history after it, the session character by default
+    def rebuild_inventory(self, campaign_id=None, character_id=None):
+        if campaign_id is None:
+            campaign_id = self.campaign_id
+        if character_id is None:
+            character_id = self.character_id
+        key = {'campaign_id': campaign_id, 'character_id': character_id}
+        with self.db_lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = self.db.cursor()
+                totals = self.__execute(cursor, REBUILD_INVENTORY_SQL, key).fetchall()
+                self.__execute(cursor, 'DELETE FROM CHARACTER_INVENTORY WHERE Campaign_ID = ? AND Character_ID = ?', (campaign_id, character_id))
+                cursor.executemany(OBTAIN_ITEM_SQL, [(campaign_id, character_id, item_id, quantity) for item_id, quantity in totals])
+                self.__execute(cursor, BUMP_GENERATION_SQL, (campaign_id, character_id))
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+            if (campaign_id, character_id) == (self.campaign_id, self.character_id):
+                self.inventory.load(self.db)
+        print(f"Rebuilt inventory of character {character_id} in campaign {campaign_id} with {len(totals)} items.")
+        return dict(totals)
+
+    def __write_checkpoint(self, cursor, campaign_id, character_id):
+        key = {'campaign_id': campaign_id, 'character_id': character_id}
+        self.__execute(cursor, WRITE_CHECKPOINT_SQL, key)
+        key['checkpoint_id'] = cursor.lastrowid
+        self.__execute(cursor, WRITE_CHECKPOINT_ITEMS_SQL, key)
+
+    # the session character's items as row dicts, served from the in-memory inventory
     def get_inventory_snapshot(self):
-        query = '''
-        SELECT * FROM CHARACTER_INVENTORY_DETAILS;
-        '''
-        return self.__run_query(query)
+        return self.inventory.snapshot()
+
+    # deltas since a version taken from inventory.version, None means take a new snapshot
+    def get_inventory_changes(self, since_version):
+        return self.inventory.changes_since(since_version)
 
     # connect to db without erasing
     # used for continuous web app
     def __connect_to_existing_db(self, db_name):
         try: 
-            db = sqlite3.connect(db_name) 
+            db = sqlite3.connect(db_name, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE, uri=self.shards is not None) 
+            self.__configure_connection(db)
+            self.__migrate_db(db, world=self.shards is None)
             print("Database lldm.db connected.") 
         except Exception as e: 
             print("Database lldm.db not connected.")
@@ -244,137 +2174,160 @@ class LLDM_Assistant:
         return db
 
     # used to create fresh db
+    # the workbook is parsed once into a template DB keyed by its hash, fresh campaigns
+    # are then cloned from the template with the backup API, a sharded campaign from the
+    # router's campaign template
     def __create_db_from_file(self, excel_filename, db_name):
+        if self.shards is not None:
+            template_name = self.shards.campaign_template
+        else:
+            template_name = self._get_template_db(excel_filename)
         try: 
-            db = sqlite3.connect(db_name) 
+            db = sqlite3.connect(db_name, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE, uri=self.shards is not None) 
             print("Database lldm.db formed.") 
         except: 
             print("Database lldm.db not formed.")
 
-        # erase current db contents
-        cursor = db.cursor()
-        query = '''
-        PRAGMA writable_schema = 1;
-        DELETE FROM sqlite_master;
-        PRAGMA writable_schema = 0;
-        VACUUM;
-        PRAGMA integrity_check;
-        '''
-        cursor.executescript(query)
-
-        # create db from excel spreadsheet
-        dfs = pd.read_excel(excel_filename, sheet_name=None)
-        for table, df in dfs.items():
-            try:
-                print(table.upper().replace(' ','_').strip())
-                df.columns = [x.replace(' ','_') for x in df.columns.values]
-                df.to_sql(table.upper().replace(' ','_').strip(), db)
-            except:
-                continue
+        # narrator assistants are not campaign state, keep them so the fresh campaign reuses them
+        try:
+            assistants = db.execute('SELECT Config_Hash, Assistant_ID FROM NARRATOR_ASSISTANTS').fetchall()
+        except sqlite3.OperationalError:
+            assistants = []
+
+        # replaces every page of the current db contents
+        template = sqlite3.connect(pathlib.Path(template_name).resolve().as_uri() + '?mode=ro', uri=True)
+        try:
+            template.backup(db)
+        finally:
+            template.close()
 
-        # modify columns
-        query = '''
-        CREATE TABLE IF NOT EXISTS CAMPAIGN (
-            Campaign_ID INTEGER NOT NULL,
-            Setting TEXT NOT NULL,
-            Start_Time TEXT NOT NULL,
-            Current_Turns INTEGER NOT NULL DEFAULT 0
-        );
-
-        ALTER TABLE CHARACTER_SHEET
-        RENAME COLUMN "index" TO Character_ID;
-
-        ALTER TABLE CHARACTER_SHEET
-        ADD COLUMN Campaign_ID INTEGER;
-
-        ALTER TABLE INVENTORY
-        RENAME COLUMN "index" TO Item_ID;
-
-        ALTER TABLE WORLD_ITEMS
-        RENAME COLUMN "index" TO Item_ID;
-
-        ALTER TABLE SETTINGS
-        RENAME COLUMN "index" TO Setting_ID;
-
-        ALTER TABLE NPCS
-        RENAME COLUMN "index" TO NPC_ID;
-
-        ALTER TABLE TREASURES
-        RENAME COLUMN "index" TO Treasure_ID;
-
-        ALTER TABLE MONSTERS
-        RENAME COLUMN "index" TO Monster_ID;
-
-        ALTER TABLE PLOT
-        RENAME COLUMN "index" TO Plot_ID;
-
-        ALTER TABLE PLOT
-        ADD COLUMN Campaign_ID INTEGER;
-
-        ALTER TABLE LOGS
-        RENAME COLUMN "index" TO Log_ID;
-
-        ALTER TABLE LOGS
-        ADD COLUMN Campaign_ID INTEGER;
-
-        ALTER TABLE LOGS
-        ADD COLUMN Character_ID INTEGER;
-
-        CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY (
-            Campaign_ID INTEGER NOT NULL,
-            Character_ID INTEGER NOT NULL,
-            Item_ID INTEGER NOT NULL,
-            Total_Quantity FLOAT DEFAULT 0
-        );
-
-        CREATE TABLE IF NOT EXISTS CHARACTER_INVENTORY_HISTORY (
-            Campaign_ID INTEGER NOT NULL,
-            Character_ID INTEGER NOT NULL,
-            Item_ID INTEGER NOT NULL,
-            Quantity FLOAT DEFAULT 0,
-            Modify_Time DATETIME DEFAULT CURRENT_TIMESTAMP
-        );
-
-        CREATE VIEW IF NOT EXISTS CHARACTER_INVENTORY_DETAILS 
-        AS
-        SELECT
-            a.Campaign_ID, a.Character_ID, a.Item_ID, a.Total_Quantity,
-            b.Weapon_Name, b.Weapon_Description
-        FROM CHARACTER_INVENTORY a
-        JOIN WORLD_ITEMS b ON a.Item_ID = b.Item_ID;
-
-        CREATE VIEW IF NOT EXISTS CHARACTER_INVENTORY_HISTORY_DETAILS 
-        AS
-        SELECT
-            a.Campaign_ID, a.Character_ID, a.Item_ID, a.Quantity, a.Modify_Time,
-            b.Weapon_Name, b.Weapon_Description
-        FROM CHARACTER_INVENTORY_HISTORY a
-        JOIN WORLD_ITEMS b ON a.Item_ID = b.Item_ID;
-        '''
-        cursor.executescript(query)
+        self.__configure_connection(db)
+        self.__migrate_db(db, world=self.shards is None)
+        db.executemany('INSERT OR REPLACE INTO NARRATOR_ASSISTANTS (Config_Hash, Assistant_ID) VALUES (?, ?)', assistants)
         db.commit()
         return db
-        
 
-    def __run_query(self, query):
+    # path of the prebuilt DB for this workbook and schema version, built on first use
+    @classmethod
+    def _get_template_db(cls, excel_filename):
+        digest = hashlib.sha256()
+        with open(excel_filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        template_dir = os.path.join(os.path.dirname(os.path.abspath(excel_filename)), TEMPLATE_DIR)
+        template_name = os.path.join(template_dir, f'{digest.hexdigest()[:32]}-v{SCHEMA_VERSION}.db')
+        if os.path.exists(template_name):
+            return template_name
+
+        os.makedirs(template_dir, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(suffix='.db', dir=template_dir)
+        os.close(fd)
+        try:
+            cls.__build_template_db(excel_filename, tmp_name)
+            # atomic, a concurrent builder of the same workbook produces an identical file
+            os.replace(tmp_name, template_name)
+        except BaseException:
+            os.remove(tmp_name)
+            raise
+        return template_name
+
+    # stream every sheet into its final table, all inserts in one transaction with journaling
+    # and syncing off since a failed build is simply thrown away
+    @classmethod
+    def __build_template_db(cls, excel_filename, db_name):
+        db = sqlite3.connect(db_name)
+        db.executescript(BULK_LOAD_PRAGMAS)
+        workbook = openpyxl.load_workbook(excel_filename, read_only=True, data_only=True)
         try:
-            df = pd.read_sql_query(query, self.db)
-            return df
+            db.execute('BEGIN')
+            for sheet in workbook.worksheets:
+                table = sheet.title.upper().replace(' ','_').strip()
+                print(table)
+                cls.__load_sheet(db, table, sheet.iter_rows(values_only=True))
+            db.executescript(CAMPAIGN_SCHEMA)
+            cls.__migrate_db(db)
+            db.commit()
+        finally:
+            workbook.close()
+            db.close()
+
+    @classmethod
+    def __load_sheet(cls, db, table, rows):
+        header = next(rows, None) or ()
+        while header and header[-1] is None:
+            header = header[:-1]
+        columns = [f'Unnamed:_{i}' if name is None else str(name).replace(' ','_') for i, name in enumerate(header)]
+        id_column, extra_columns = SHEET_TABLES.get(table, ('index', ()))
+
+        # column types come from the first rows, the rest are streamed straight into executemany
+        head = list(itertools.islice(cls.__sheet_records(rows, len(columns)), SHEET_TYPE_SAMPLE_ROWS))
+        definitions = [f'"{id_column}" INTEGER PRIMARY KEY']
+        for i, column in enumerate(columns):
+            definitions.append(f'"{column}" {cls.__column_type(row[i] for row in head)}')
+        definitions.extend(extra_columns)
+        db.execute(f'CREATE TABLE "{table}" ({", ".join(definitions)})')
+
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        records = itertools.chain(head, cls.__sheet_records(rows, len(columns)))
+        column_names = ', '.join(f'"{name}"' for name in [id_column] + columns)
+        db.executemany(
+            f'INSERT INTO "{table}" ({column_names}) VALUES ({placeholders})',
+            ((row_id, *record) for row_id, record in enumerate(records))
+        )
+
+    # sheet rows padded/cut to the header width, blank rows skipped, dates stored as text
+    @staticmethod
+    def __sheet_records(rows, width):
+        for row in rows:
+            record = tuple(row[:width]) + (None,) * (width - len(row))
+            if all(value is None for value in record):
+                continue
+            yield tuple(str(value) if isinstance(value, (datetime.date, datetime.time)) else value for value in record)
+
+    @staticmethod
+    def __column_type(values):
+        types = {type(value) for value in values if value is not None}
+        if types and types <= {int, bool}:
+            return 'INTEGER'
+        if types and types <= {int, bool, float}:
+            return 'REAL'
+        return 'TEXT'
+
+    # (column names, rows) of a select statement, None for anything else
+    def __run_query(self, query, db=None, params=None):
+        db = db or self.db
+        start = time.perf_counter()
+        cursor = db.cursor()
+        cursor.execute(query, params or ())
         # not a select statement
-        except TypeError:
-            cursor = self.db.cursor()
-            cursor.execute(query)
-            return  
+        if cursor.description is None:
+            self.tracer.query(query, start, cursor.rowcount)
+            return
+        rows = cursor.fetchall()
+        self.tracer.query(query, start, len(rows))
+        return [column[0] for column in cursor.description], rows
+
+    # cursor.execute, traced under the statement's fingerprint
+    def __execute(self, cursor, sql, params=()):
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        # sqlite only knows the row count of DML up front
+        self.tracer.query(sql, start, cursor.rowcount if cursor.rowcount >= 0 else None)
+        return cursor
         
-    def ___validate_item(self, item_name):
-        query = f'''
-        SELECT * FROM WORLD_ITEMS WHERE UPPER(Weapon_Name) LIKE "{item_name.upper()}%" 
-        '''
-        tmp = self.__run_query(query)
-        if not tmp.empty:
-            return tmp['Item_ID'].iloc[0]
+    def __validate_item(self, item_name):
+        match = self.catalog.resolve(item_name)
+        if match is not None:
+            return match[0]
         return None
 
+    # close names to offer back to the model when an item name could not be resolved
+    def __item_suggestions(self, item_name):
+        candidates = self.catalog.candidates(item_name)
+        if not candidates:
+            return ''
+        return ' Closest known items: ' + ', '.join(name for _, name, _ in candidates) + '.'
+
     # update table if item validated, otherwise error message
     # for now, use temporary campaign and character id
     def __get_obtained_item(self, item_name, quantity, campaign_id=0, character_id=0):
@@ -384,105 +2337,492 @@ class LLDM_Assistant:
             # TODO: error handling
             cursor = self.db.cursor()
 
-            # overall character inventory tracker update
-            query = f'''
-            UPDATE CHARACTER_INVENTORY SET Total_Quantity = Total_Quantity + {quantity}
-            WHERE Item_ID = {item_id} AND Campaign_ID = {campaign_id} AND Character_ID = {character_id}
-            '''
-            cursor.execute(query)
-
-            if cursor.rowcount == 0:
-                query = f'''
-                INSERT INTO CHARACTER_INVENTORY (Campaign_ID, Character_ID, Item_ID, Total_Quantity) VALUES ({campaign_id}, {character_id}, {item_id}, {quantity})
-                '''
-                cursor.execute(query)
+            # overall character inventory tracker update, inserts the row on first pickup
+            self.__execute(cursor, OBTAIN_ITEM_SQL, (campaign_id, character_id, item_id, quantity))
+            self.__execute(cursor, BUMP_GENERATION_SQL, (campaign_id, character_id))
 
             # inventory history update
-            query = f'''
-            INSERT INTO CHARACTER_INVENTORY_HISTORY (Campaign_ID, Character_ID, Item_ID, Quantity) VALUES ({campaign_id}, {character_id}, {item_id}, {quantity})
-            '''
-            cursor.execute(query)
+            self.__execute(cursor, RECORD_HISTORY_SQL, (campaign_id, character_id, item_id, quantity))
+
+            self.__track_inventory_change(cursor, campaign_id, character_id, item_id, quantity)
 
-            return json.dumps({'message':'The item(s) were successfully obtained. Please continue the story.'})
+            return self.result_encoder.encode('The item(s) were successfully obtained. Please continue the story.')
         else:
-            return json.dumps({'message':'Item does not exist. Please prompt user to specify further or provide another action.'})
-
-    # check if item queried is in INVENTORY table and character has more than discard amount
-    # might need a third error condition if item exists, user has item, but has less than discard amount
-    def __validate_item_discard(self, item_name, quantity, campaign_id, character_id):
-        query = f'''
-        SELECT * FROM WORLD_ITEMS WHERE UPPER(Weapon_Name) LIKE "{item_name.upper()}%" 
-        '''
-        tmp = self.__run_query(query)
-        if not tmp.empty: # item exists in world
-            item_id = tmp['Item_ID'].iloc[0]
-            # validate if character has item
-            query = f'''
-            SELECT * FROM CHARACTER_INVENTORY 
-            WHERE Campaign_ID = {campaign_id} AND Character_ID = {character_id} AND Item_ID = {item_id} AND Total_Quantity >= {quantity}
-            '''
-            # there should theoretically only be one row of the item for each character with the quantity as different values
-            # need to validate and put checks in place
-            tmp = self.__run_query(query)
-            if not tmp.empty:
-                return item_id
-            raise self.ItemNotPossessedException("Character does not have the item in their inventory.")
-        raise self.ItemNotFoundException("Item does not exist in this campaign.")
+            return self.result_encoder.encode('Item does not exist. Please prompt user to specify further or provide another action.' + self.__item_suggestions(item_name))
 
     # update table if item validated, otherwise error message
     # for now, use temporary campaign and character id
-    # first update with item subtraction, then remove all entries with <=0 values
+    # the subtraction only applies if the character holds enough of the item, then the row is
+    # removed if it reached 0
     def __get_discarded_item(self, item_name, quantity, campaign_id=0, character_id=0):
         try:
-            item_id = self.__validate_item_discard(item_name, quantity, campaign_id, character_id)
-            
+            item_id = self.__validate_item(item_name)
+            if item_id is None:
+                raise self.ItemNotFoundException("Item does not exist in this campaign.")
+
             cursor = self.db.cursor()
 
             # overall inventory tracker update
-            query = f'''
-            UPDATE CHARACTER_INVENTORY SET Total_Quantity = Total_Quantity - {quantity}
-            WHERE Item_ID = {item_id} AND Campaign_ID = {campaign_id} AND Character_ID = {character_id};
-            '''
-            cursor.execute(query)
+            self.__execute(cursor, DISCARD_ITEM_SQL, (quantity, campaign_id, character_id, item_id, quantity))
+            if cursor.rowcount == 0:
+                raise self.ItemNotPossessedException("Character does not have the item in their inventory.")
 
-            # housekeeping query, remove rows with invalid quantites (<= 0 items)
-            query = 'DELETE FROM CHARACTER_INVENTORY WHERE Total_Quantity <= 0'
-            cursor.execute(query)
+            # housekeeping query, remove the row if nothing is left of the item
+            self.__execute(cursor, REMOVE_EMPTY_ITEM_SQL, (campaign_id, character_id, item_id))
+            self.__execute(cursor, BUMP_GENERATION_SQL, (campaign_id, character_id))
 
             # inventory history tracker update
             # use negative quantity value to indicate 
-            query = f'''
-            INSERT INTO CHARACTER_INVENTORY_HISTORY (Campaign_ID, Character_ID, Item_ID, Quantity) VALUES ({campaign_id}, {character_id}, {item_id}, {-quantity})
-            '''
-            cursor.execute(query)
+            self.__execute(cursor, RECORD_HISTORY_SQL, (campaign_id, character_id, item_id, -quantity))
 
-            return json.dumps({'message':'The item(s) were successfully discarded. Please continue the story.'})
+            self.__track_inventory_change(cursor, campaign_id, character_id, item_id, -quantity)
+
+            return self.result_encoder.encode('The item(s) were successfully discarded. Please continue the story.')
         except self.ItemNotPossessedException as e:
-            return json.dumps({'message':"Item is not in character's possession. Please prompt user to specify further or provide another action."})
+            return self.result_encoder.encode("Item is not in character's possession. Please prompt user to specify further or provide another action.")
         except self.ItemNotFoundException as e:
-            return json.dumps({'message':"Item does not exist. Please prompt user to specify further or provide another action."})
-
-
-    def __get_item_info(self, sql_query, campaign_id=0, character_id=0):
-        self.__run_query('PRAGMA QUERY_ONLY = ON;')
-        try:
-            
+            return self.result_encoder.encode("Item does not exist. Please prompt user to specify further or provide another action." + self.__item_suggestions(item_name))
+
+    # queue the change for the in-memory inventory, it is applied once the step commits
+    def __track_inventory_change(self, cursor, campaign_id, character_id, item_id, change):
+        if (campaign_id, character_id) != (self.inventory.campaign_id, self.inventory.character_id):
+            return
+        name = description = None
+        if not self.inventory.holds(item_id):
+            name, description = self.__execute(cursor, ITEM_DETAILS_SQL, (item_id,)).fetchone()
+        self._pending_inventory.append((item_id, change, name, description))
+
+    # collapse whitespace outside of string literals and drop trailing semicolons, so repeated
+    # questions map to the same cache entries
+    @staticmethod
+    def __normalize_query(sql_query):
+        sql_query = re.sub(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+", lambda m: m.group(1) or ' ', sql_query)
+        return sql_query.strip().rstrip(';').strip()
+
+    # scope the model's query to one character, with the IDs left as parameters so the
+    # rewrite is shared across campaigns
+    # the LIMIT fetches one row past QUERY_MAX_ROWS, so a cut-off result can be told apart
+    def __rewrite_query(self, sql_query):
+        key = self.__normalize_query(sql_query)
+        rewritten = self._query_rewrites.get(key)
+        if rewritten is None:
             # at some point in life, will figure out how to remove existing ID matching clauses before adding these
             # but for now this will do
-            where = sqlglot.condition(f'Campaign_ID={campaign_id}').and_(f'Character_ID={character_id}')
-            sql_query = sqlglot.parse_one(sql_query).where(where).sql()
+            where = sqlglot.condition('Campaign_ID = ?').and_('Character_ID = ?')
+            statement = sqlglot.parse_one(key).where(where)
+            limit = statement.args.get('limit')
+            if limit is None or not limit.expression.is_int or int(limit.expression.name) > QUERY_MAX_ROWS + 1:
+                statement = statement.limit(QUERY_MAX_ROWS + 1)
+            rewritten = statement.sql()
+            self._query_rewrites.put(key, rewritten)
+        return rewritten
+
+    # runs on a pooled read-only connection, so calls of one step can run in parallel
+    # repeated questions are answered from query_results until the character's inventory changes
+    def __get_item_info(self, sql_query, campaign_id=0, character_id=0):
+        try:
+            sql_query = self.__rewrite_query(sql_query)
             # print(sql_query)
 
-            df_result = self.__run_query(sql_query)
-            result = json.dumps(df_result.to_dict())
-            # print(result)
+            key = (sql_query, campaign_id, character_id)
+            with self.readers.connection() as db:
+                # read before the query, a change committed in between only makes the entry miss
+                generation = self.__execute(db.cursor(), GET_GENERATION_SQL, (campaign_id, character_id)).fetchone()
+                cached = self.query_results.get(key)
+                if cached is not None and cached[0] == generation:
+                    return cached[1]
+                with self.query_guard.guard(db, sql_query, (campaign_id, character_id)):
+                    columns, rows = self.__run_query(sql_query, db, params=(campaign_id, character_id))
+            # print(rows)
+
+            # the LIMIT fetched one row more than is sent, so there is more past it
+            output = self.result_encoder.encode(
+                "The result of the user's request is given as columns and rows. Please use this to answer the user's question or honor the user's request.",
+                columns, rows[:QUERY_MAX_ROWS], complete=len(rows) <= QUERY_MAX_ROWS
+            )
+            self.query_results.put(key, (generation, output))
+            return output
+        except QueryGuard.QueryRejectedException as e:
+            self.tracer.increment('lldm_db_rejected_queries_total')
+            return self.result_encoder.encode(f"The query was rejected because {e}. Please generate a narrower query, or prompt the user for another action.")
+        except Exception as e:
+            return self.result_encoder.encode("Something went wrong, please prompt the user for another action")
+
+
+# same DB and tool functions as LLDM_Assistant, but the OpenAI calls and the run loop are
+# coroutines and blocking sqlite work runs in a bounded executor, so one event loop can
+# drive many campaigns at once
+# construction does no network I/O, await start() before chatting
+class AsyncLLDM_Assistant(LLDM_Assistant):
+
+    _shared_executor = None
+
+    def __init__(self, api_key, db_name, excel_db_filename=None, use_streaming=True, campaign_id=0, character_id=0, client=None, executor=None, tracer=None, fast_path=False, fast_path_threshold=FAST_PATH_CONFIDENCE, context_budget=CONTEXT_TOKEN_BUDGET, shards=None, pool=None):
+        # pass the same client/executor to every campaign to share HTTP connections and DB threads
+        self.client = client or AsyncOpenAI(api_key=api_key)
+        self.shards = shards
+        self.pool = pool
+        self.context_budget = context_budget
+        self.tracer = tracer or NULL_TRACER
+        self.last_trace_id = None
+        self.fast_path = fast_path
+        self.fast_path_threshold = fast_path_threshold
+        self.executor = executor or self.__default_executor()
+        self.use_streaming = use_streaming
+        self.campaign_id = campaign_id
+        self.character_id = character_id
+        self.last_turn_timings = {}
+        self.narrator_id = None
+        self.thread_id = None
+        self._open_db(db_name, excel_db_filename)
+
+    @classmethod
+    def __default_executor(cls):
+        if cls._shared_executor is None:
+            cls._shared_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='lldm-db')
+        return cls._shared_executor
+
+    async def start(self):
+        self.narrator_id = await self.__run_blocking(self.registry.assistant_id, NARRATOR_CONFIG_HASH)
+        if self.narrator_id is None:
+            self.narrator_id = (await self.client.beta.assistants.create(**NARRATOR_CONFIG)).id
+            stale_ids = await self.__run_blocking(self.registry.save_assistant, NARRATOR_CONFIG_HASH, self.narrator_id)
+            for stale_id in stale_ids:
+                try:
+                    await self.client.beta.assistants.delete(stale_id)
+                    print(f"Deleted outdated assistant {stale_id}.")
+                except Exception as e:
+                    print(f"Could not delete outdated assistant {stale_id}.")
+                    print(repr(e))
+
+        self.thread_id = await self.__run_blocking(self.registry.thread_id, self.campaign_id)
+        if self.thread_id is None:
+            self.thread_id = (await self.client.beta.threads.create()).id
+            await self.__run_blocking(self.registry.save_thread, self.campaign_id, self.thread_id)
+        self.history = ChatHistory(self.thread_id)
+        return self
+
+    # the current span goes along, so spans recorded in the executor join this turn's trace
+    async def __run_blocking(self, func, *args):
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, func, *args)
+
+    async def narrator_chat(self, content, new_only=False):
+        with self.tracer.span('narrator_chat', campaign_id=self.campaign_id, character_id=self.character_id, thread_id=self.thread_id) as span:
+            self.last_trace_id = span.trace_id
+            self.tracer.increment('lldm_turns_total')
+            if self.fast_path:
+                routed = await self.__run_blocking(self.router.route, content)
+                if routed is not None and routed[2] >= self.fast_path_threshold:
+                    span.set(fast_path=routed[0])
+                    self.tracer.increment('lldm_fast_path_total', intent=routed[0])
+                    return await self.__fast_path_turn(content, routed[1], new_only)
+            return await self.__chat_turn(content, new_only)
+
+    async def __fast_path_turn(self, content, answer, new_only):
+        print('Answering from the inventory...')
+        timings = {}
+        start = time.perf_counter()
+        await self.client.beta.threads.messages.create(
+            thread_id=self.thread_id,
+            role="user",
+            content=f"""
+            {content}
+            """,
+        )
+        await self.client.beta.threads.messages.create(thread_id=self.thread_id, role="assistant", content=answer)
+        _add_timing(self.tracer, timings, 'message_create', start)
+
+        start = time.perf_counter()
+        new_messages = await self.__fetch_new_messages()
+        _add_timing(self.tracer, timings, 'history_list', start)
+
+        self.last_turn_timings = timings
+        _report_timings(timings)
+        if new_only:
+            return new_messages[::-1]
+        return self.history.view()
+
+    async def __chat_turn(self, content, new_only):
+        timings = {}
+        run_options = {}
+        if self.memory is not None:
+            if self.memory.needs_rotation(self.history, content):
+                await self.__rotate_thread(timings)
+            start = time.perf_counter()
+            events = await self.__run_blocking(self.memory.retrieve, content)
+            if events is not None:
+                run_options['additional_instructions'] = events
+            _add_timing(self.tracer, timings, 'retrieve', start)
+
+        start = time.perf_counter()
+        message = await self.client.beta.threads.messages.create(
+            thread_id=self.thread_id,
+            role="user",
+            content=f"""
+            {content}
+            """,
+        )
+        _add_timing(self.tracer, timings, 'message_create', start)
+
+        if self.use_streaming and hasattr(self.client.beta.threads.runs, 'stream'):
+            run = await self.__stream_run(timings, run_options)
+        else:
+            run = await self.__poll_run(timings, run_options)
+
+        start = time.perf_counter()
+        new_messages = await self.__fetch_new_messages()
+        _add_timing(self.tracer, timings, 'history_list', start)
+
+        self.last_turn_timings = timings
+        _report_timings(timings)
+        if new_only:
+            return new_messages[::-1]
+        return self.history.view()
 
-            self.__run_query('PRAGMA QUERY_ONLY = OFF;')
-            return json.dumps({'message':f"The result of the user's request in JSON format is {result}. Please use this to answer the user's question or honor the user's request."})
+    async def __rotate_thread(self, timings):
+        start = time.perf_counter()
+        try:
+            completion = await self.client.chat.completions.create(model=SUMMARY_MODEL, messages=self.memory.summary_messages(self.history))
         except Exception as e:
-            self.__run_query('PRAGMA QUERY_ONLY = OFF;')
-            return json.dumps({'message':"Something went wrong, please prompt the user for another action"})
-        
+            print("Could not summarize the campaign thread.")
+            print(repr(e))
+            return
+        summary = await self.__run_blocking(self.memory.record_summary, completion.choices[0].message.content)
+        seed = self.memory.seed_messages(summary, self.inventory.snapshot(), self.history)
+        thread_id = (await self.client.beta.threads.create(messages=seed)).id
+        await self.__run_blocking(self.registry.save_thread, self.campaign_id, thread_id)
+        print(f"Continuing campaign {self.campaign_id} on thread {thread_id}.")
+        self.thread_id = thread_id
+        self.history = ChatHistory(thread_id)
+        _add_timing(self.tracer, timings, 'rotate_thread', start)
+
+    async def __fetch_new_messages(self):
+        new_messages = []
+        has_more = True
+        while has_more:
+            page = await self.client.beta.threads.messages.list(**self.history.list_params())
+            entries, has_more = self.history.extend(page)
+            new_messages.extend(entries)
+        return new_messages
+
+    async def __stream_run(self, timings, run_options):
+        runs = self.client.beta.threads.runs
+        manager = runs.stream(
+            thread_id=self.thread_id,
+            assistant_id=self.narrator_id,
+            **run_options,
+        )
+        run = None
+        while manager is not None:
+            start = time.perf_counter()
+            async with manager as stream:
+                manager = None
+                async for event in stream:
+                    if event.event == 'thread.run.requires_action':
+                        _add_timing(self.tracer, timings, 'run_wait', start)
+                        run = event.data
+                        tool_outputs = await self.__dispatch_tool_calls(run, timings)
+                        print("Submitting outputs back to the Assistant…")
+                        manager = runs.submit_tool_outputs_stream(
+                            thread_id=self.thread_id,
+                            run_id=run.id,
+                            tool_outputs=tool_outputs
+                        )
+                        break
+                    if event.event in RUN_TERMINAL_EVENTS:
+                        _add_timing(self.tracer, timings, 'run_wait', start)
+                        run = event.data
+            _report_run_status(run)
+        return run
+
+    async def __poll_run(self, timings, run_options):
+        runs = self.client.beta.threads.runs
+        start = time.perf_counter()
+        run = await runs.create(
+            thread_id=self.thread_id,
+            assistant_id=self.narrator_id,
+            **run_options,
+        )
+        _add_timing(self.tracer, timings, 'run_create', start)
+
+        delay = POLL_MIN_INTERVAL
+        while run.status not in RUN_TERMINAL_STATUSES:
+            if run.status == 'requires_action':
+                tool_outputs = await self.__dispatch_tool_calls(run, timings)
+                print("Submitting outputs back to the Assistant…")
+                start = time.perf_counter()
+                run = await runs.submit_tool_outputs(
+                    thread_id=self.thread_id,
+                    run_id=run.id,
+                    tool_outputs=tool_outputs
+                )
+                _add_timing(self.tracer, timings, 'submit', start)
+                delay = POLL_MIN_INTERVAL
+                continue
+            if run.status == "cancelling":
+                print("Run cancelling.")
+
+            start = time.perf_counter()
+            await asyncio.sleep(delay)
+            delay = min(delay * POLL_BACKOFF, POLL_MAX_INTERVAL)
+            run = await runs.retrieve(
+                thread_id=self.thread_id,
+                run_id=run.id,
+            )
+            _add_timing(self.tracer, timings, 'poll', start)
+
+        _report_run_status(run)
+        return run
+
+    async def __dispatch_tool_calls(self, run, timings):
+        print('Function calling...')
+        start = time.perf_counter()
+        tool_outputs = await self.__run_blocking(self._run_tool_calls, run.required_action.submit_tool_outputs.tool_calls)
+        _add_timing(self.tracer, timings, 'tool_calls', start)
+        return tool_outputs
+
+    # in memory, no executor hop needed
+    async def get_inventory_snapshot(self):
+        return super().get_inventory_snapshot()
+
+
+# a character's assistant inside a SessionManager, busy counts the requests using it right now
+class _SessionEntry:
+
+    def __init__(self):
+        self.db_name = None
+        self.assistant = None
+        self.busy = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+# player sessions of a long-running server mapped onto long-lived assistants, safe to call from
+# any number of request threads
+# sessions playing the same character share one assistant and every DB file one ConnectionPool,
+# so a process holds a single writer per file; turns of a campaign run one at a time since its
+# characters share the narrator thread, snapshots never wait for a turn
+# an assistant idle for idle_timeout seconds, or the least recently used one past max_assistants,
+# is dropped and reopened (from the DB and the registry) on its session's next request
+# assistant_options are passed on to every LLDM_Assistant, e.g. tracer or fast_path
+class SessionManager:
+
+    class SessionNotFoundException(Exception):
+        pass
+
+    def __init__(self, api_key, db_name=None, client=None, shards=None, max_assistants=SESSION_MAX_ASSISTANTS, idle_timeout=SESSION_IDLE_TIMEOUT, **assistant_options):
+        self.client = client or OpenAI(api_key=api_key)
+        self.db_name = db_name
+        self.shards = shards
+        self.max_assistants = max_assistants
+        self.idle_timeout = idle_timeout
+        self.assistant_options = assistant_options
+        self.__lock = threading.Lock()
+        self.__sessions = {}    # session ID -> (campaign ID, character ID)
+        self.__entries = collections.OrderedDict()    # (campaign ID, character ID) -> _SessionEntry, least recently used first
+        self.__pools = {}   # DB file -> (ConnectionPool, open assistants)
+        self.__turn_locks = {}  # campaign ID -> lock held for a whole narrator turn
+
+    def open_session(self, session_id, campaign_id=0, character_id=0):
+        with self.__lock:
+            self.__sessions[session_id] = (campaign_id, character_id)
+
+    def close_session(self, session_id):
+        with self.__lock:
+            key = self.__sessions.pop(session_id, None)
+            entry = self.__entries.get(key)
+            if entry is not None and entry.busy == 0 and key not in self.__sessions.values():
+                self.__drop(key)
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+    def narrator_chat(self, session_id, content, new_only=False):
+        with self.__assistant(session_id) as (assistant, turn_lock):
+            with turn_lock:
+                return assistant.narrator_chat(content, new_only)
+
+    def get_inventory_snapshot(self, session_id):
+        with self.__assistant(session_id) as (assistant, _):
+            return assistant.get_inventory_snapshot()
+
+    def get_inventory_changes(self, session_id, since_version):
+        with self.__assistant(session_id) as (assistant, _):
+            return assistant.get_inventory_changes(since_version)
+
+    # the session's assistant, opened on first use; it can't be evicted while a request holds it
+    @contextlib.contextmanager
+    def __assistant(self, session_id):
+        with self.__lock:
+            key = self.__sessions.get(session_id)
+            if key is None:
+                raise SessionManager.SessionNotFoundException(f"Unknown session {session_id}.")
+            entry = self.__entries.get(key)
+            if entry is None:
+                entry = self.__entries[key] = _SessionEntry()
+            self.__entries.move_to_end(key)
+            entry.busy += 1
+            turn_lock = self.__turn_locks.setdefault(key[0], threading.Lock())
+        try:
+            with entry.lock:
+                if entry.assistant is None:
+                    # under the turn lock, so a new campaign gets a single thread
+                    with turn_lock:
+                        db_name = self.shards.shard_path(key[0]) if self.shards is not None else self.db_name
+                        entry.assistant = self.__open_assistant(key, db_name)
+                        entry.db_name = db_name
+            yield entry.assistant, turn_lock
+        finally:
+            with self.__lock:
+                entry.busy -= 1
+                entry.last_used = time.monotonic()
+                self.__evict()
+
+    def __open_assistant(self, key, db_name):
+        with self.__lock:
+            pool, users = self.__pools.get(db_name, (None, 0))
+            if pool is None:
+                pool = ConnectionPool()
+            # counted before it's connected, so a concurrent eviction can't close it meanwhile
+            self.__pools[db_name] = (pool, users + 1)
+        try:
+            return LLDM_Assistant(None, db_name, campaign_id=key[0], character_id=key[1], client=self.client, shards=self.shards, pool=pool, **self.assistant_options)
+        except BaseException:
+            with self.__lock:
+                self.__release_pool(db_name)
+            raise
+
+    # idle entries sit at the front, busy ones are skipped and looked at again on their release
+    def __evict(self):
+        now = time.monotonic()
+        for key, entry in list(self.__entries.items()):
+            if entry.busy:
+                continue
+            if len(self.__entries) <= self.max_assistants and now - entry.last_used < self.idle_timeout:
+                break
+            self.__drop(key)
+
+    def __drop(self, key):
+        entry = self.__entries.pop(key)
+        if entry.assistant is not None:
+            entry.assistant = None
+            self.__release_pool(entry.db_name)
+        if not any(campaign_id == key[0] for campaign_id, _ in self.__entries):
+            self.__turn_locks.pop(key[0], None)
+
+    def __release_pool(self, db_name):
+        pool, users = self.__pools[db_name]
+        if users > 1:
+            self.__pools[db_name] = (pool, users - 1)
+        else:
+            del self.__pools[db_name]
+            pool.close()
+
+    def close(self):
+        with self.__lock:
+            for key in [key for key, entry in self.__entries.items() if entry.busy == 0]:
+                self.__drop(key)
 
 # Main function, testing purposes
 if __name__ == '__main__':
@@ -0,0 +1,296 @@
+import os
+import io
+import json
+import time
+import random
+import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import contextlib
+import collections
+import multiprocessing
+
+from lldm import LLDM_Assistant, ConnectionPool, ShardRouter
+from fake_openai import FakeOpenAI
+from bench import percentile, tool_call, build_template, world_item_names
+
+# Replays streams of tool calls straight into the inventory layer, no model involved, to check
+# storage changes for speed and for correctness.
+#
+#   python replay.py --campaigns 32 --characters 4 --steps 500 --workers 8
+#   python replay.py --stream recorded.jsonl --db lldm.db
+#   python replay.py --campaigns 32 --shards --write-stream synthetic.jsonl
+#
+# a stream is JSONL, one run step per line with its tool calls as the Assistants API delivers
+# them, i.e. arguments still JSON-encoded:
+#   {"campaign_id": 3, "character_id": 1, "tool_calls": [{"name": "get_obtained_item", "arguments": "{\"item_name\": \"Shadow Lance of Storm\", \"quantity\": 2}"}]}
+#
+# every campaign is replayed by one worker process in stream order, so the final state does not
+# depend on the number of workers and the checksums of two runs of a stream must match
+
+# tool output message -> outcome, first match wins
+OUTCOMES = (
+    ('successfully', 'ok'),
+    ('given as columns and rows', 'ok'),
+    ('does not exist', 'not_found'),
+    ("not in character's possession", 'not_possessed'),
+    ('was rejected', 'rejected'),
+)
+
+# the model's usual questions, see bench.turn_script
+SYNTHETIC_QUERIES = (
+    'SELECT SUM(Total_Quantity) AS Total FROM CHARACTER_INVENTORY_DETAILS',
+    'SELECT Weapon_Name, Total_Quantity FROM CHARACTER_INVENTORY_DETAILS',
+    'SELECT Weapon_Name, Quantity, Modify_Time FROM CHARACTER_INVENTORY_HISTORY_DETAILS ORDER BY Modify_Time DESC LIMIT 5',
+)
+
+# per-character final state, the history in order but without timestamps or IDs, so it is
+# comparable across runs whatever other characters wrote in between
+CHECKSUM_INVENTORY_SQL = '''
+SELECT Item_ID, Total_Quantity FROM CHARACTER_INVENTORY
+WHERE Campaign_ID = ? AND Character_ID = ?
+ORDER BY Item_ID
+'''
+
+CHECKSUM_HISTORY_SQL = '''
+SELECT Item_ID, Quantity FROM (
+    SELECT History_ID, Item_ID, Quantity FROM CHARACTER_INVENTORY_HISTORY_ARCHIVE
+    WHERE Campaign_ID = ? AND Character_ID = ?
+    UNION ALL
+    SELECT History_ID, Item_ID, Quantity FROM CHARACTER_INVENTORY_HISTORY
+    WHERE Campaign_ID = ? AND Character_ID = ?
+)
+ORDER BY History_ID
+'''
+
+def outcome(output):
+    message = json.loads(output)['message']
+    for text, label in OUTCOMES:
+        if text in message:
+            return label
+    return 'error'
+
+def read_stream(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def write_stream(path, steps):
+    with open(path, 'w') as f:
+        for step in steps:
+            f.write(json.dumps(step) + '\n')
+
+# one character's steps: pickups, discards (sometimes more than is held, or of misspelled
+# names) and inventory questions, seeded per character so streams don't depend on each other
+def synthetic_steps(names, campaign_id, character_id, steps, seed):
+    rng = random.Random(f'{seed}-{campaign_id}-{character_id}')
+    held = collections.Counter()
+    for _ in range(steps):
+        roll = rng.random()
+        if roll < 0.4:
+            calls = []
+            for name in rng.sample(names, rng.randint(1, 3)):
+                quantity = rng.randint(1, 3)
+                held[name] += quantity
+                # the model does not always spell the item the way the catalog does
+                calls.append(('get_obtained_item', {'item_name': name.lower() if rng.random() < 0.2 else name, 'quantity': quantity}))
+        elif roll < 0.6 and held:
+            name = rng.choice(sorted(held))
+            quantity = rng.randint(1, held[name] + 1)
+            held[name] = max(held[name] - quantity, 0)
+            calls = [('get_discarded_item', {'item_name': name, 'quantity': quantity})]
+        elif roll < 0.65:
+            calls = [('get_obtained_item', {'item_name': f'Unheard-of Relic {rng.randint(0, 999)}', 'quantity': 1})]
+        else:
+            calls = [('get_item_info', {'sql_query': rng.choice(SYNTHETIC_QUERIES)})]
+        yield {
+            'campaign_id': campaign_id,
+            'character_id': character_id,
+            'tool_calls': [{'name': name, 'arguments': json.dumps(arguments)} for name, arguments in calls],
+        }
+
+# characters of a campaign take turns, like players at one table
+def synthetic_stream(names, campaigns, characters, steps, seed):
+    for campaign_id in range(campaigns):
+        streams = [synthetic_steps(names, campaign_id, character_id, steps, seed) for character_id in range(characters)]
+        for turn in zip(*streams):
+            yield from turn
+
+# per-process setup of the pool workers, the shard router is opened once per process
+_worker = {}
+
+def init_worker(db_name, shard_dir, excel_db_filename):
+    _worker['db_name'] = db_name
+    _worker['shards'] = ShardRouter(shard_dir, excel_db_filename) if shard_dir else None
+
+# replay one campaign's steps, returns per-step latencies and outcome counts
+def replay_campaign(task):
+    campaign_id, steps = task
+    shards = _worker['shards']
+    # one writer per campaign DB, shared by its characters
+    pool = ConnectionPool()
+    assistants = {}
+    latencies = collections.defaultdict(list)
+    outcomes = collections.Counter()
+    calls = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        for step in steps:
+            character_id = step['character_id']
+            assistant = assistants.get(character_id)
+            if assistant is None:
+                assistant = assistants[character_id] = LLDM_Assistant(
+                    None, _worker['db_name'], campaign_id=campaign_id, character_id=character_id,
+                    client=FakeOpenAI(), context_budget=None, shards=shards, pool=pool
+                )
+            tool_calls = [tool_call(call['name'], json.loads(call['arguments']), f'call_{i}') for i, call in enumerate(step['tool_calls'])]
+            functions = {call['name'] for call in step['tool_calls']}
+            start = time.perf_counter()
+            outputs = assistant._run_tool_calls(tool_calls)
+            latencies[functions.pop() if len(functions) == 1 else 'mixed'].append(time.perf_counter() - start)
+            calls += len(tool_calls)
+            for output, call in zip(outputs, step['tool_calls']):
+                outcomes[(call['name'], outcome(output['output']))] += 1
+
+    # the write-through inventory has to agree with what was committed
+    mismatches = 0
+    for character_id, assistant in assistants.items():
+        with assistant.db_lock:
+            committed = {row[0]: row[1] for row in assistant.db.execute(
+                'SELECT Item_ID, Total_Quantity FROM CHARACTER_INVENTORY WHERE Campaign_ID = ? AND Character_ID = ?', (campaign_id, character_id)
+            )}
+        cached = {row['Item_ID']: row['Total_Quantity'] for row in assistant.get_inventory_snapshot()}
+        mismatches += committed != cached
+    pool.close()
+    return {'campaign_id': campaign_id, 'calls': calls, 'latencies': dict(latencies), 'outcomes': outcomes, 'snapshot_mismatches': mismatches}
+
+def state_checksums(db_name, shards, characters):
+    checksums = {}
+    for campaign_id, character_id in sorted(characters):
+        path = shards.shard_path(campaign_id) if shards is not None else db_name
+        with contextlib.closing(sqlite3.connect(path)) as db:
+            digest = hashlib.sha256()
+            key = (campaign_id, character_id)
+            for row in db.execute(CHECKSUM_INVENTORY_SQL, key):
+                digest.update(repr(row).encode())
+            digest.update(b'|')
+            for row in db.execute(CHECKSUM_HISTORY_SQL, key * 2):
+                digest.update(repr(row).encode())
+        checksums[f'{campaign_id}/{character_id}'] = digest.hexdigest()
+    combined = hashlib.sha256(json.dumps(checksums, sort_keys=True).encode()).hexdigest()
+    return combined, checksums
+
+# copy through the backup API, so a live DB in WAL mode is copied consistently
+def clone_db(source, target):
+    with contextlib.closing(sqlite3.connect(source)) as src, contextlib.closing(sqlite3.connect(target)) as dst:
+        src.backup(dst)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay tool-call streams against the inventory layer in parallel worker processes.')
+    parser.add_argument('--excel', default='DnD.xlsx')
+    parser.add_argument('--stream', help='JSONL stream to replay, synthetic if not given')
+    parser.add_argument('--write-stream', help='also write the replayed stream to this file')
+    parser.add_argument('--db', help='replay against a clone of this DB instead of a fresh one')
+    parser.add_argument('--shards', action='store_true', help='one DB per campaign next to a shared world DB, see ShardRouter')
+    parser.add_argument('--campaigns', type=int, default=16)
+    parser.add_argument('--characters', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=200, help='synthetic steps per character')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help='keep the replayed DBs in this directory')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    if args.db and args.shards:
+        parser.error('--db clones a single DB, it cannot be combined with --shards')
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='lldm-replay-')
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        db_name = os.path.join(work_dir, 'replay.db')
+        shard_dir = os.path.join(work_dir, 'shards') if args.shards else None
+        shards = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            if args.db:
+                clone_db(args.db, db_name)
+            elif args.shards:
+                shards = ShardRouter(shard_dir, args.excel)
+            else:
+                shutil.move(build_template(args.excel, work_dir), db_name)
+
+        if args.stream:
+            steps = list(read_stream(args.stream))
+        else:
+            names = world_item_names(shards.world_name if shards is not None else db_name)
+            steps = list(synthetic_stream(names, args.campaigns, args.characters, args.steps, args.seed))
+        if args.write_stream:
+            write_stream(args.write_stream, steps)
+
+        campaigns = collections.defaultdict(list)
+        for step in steps:
+            campaigns[step['campaign_id']].append(step)
+        # shards are created up front, so workers only ever open existing campaign files
+        if shards is not None:
+            for campaign_id in campaigns:
+                shards.shard_path(campaign_id)
+
+        latencies = collections.defaultdict(list)
+        outcomes = collections.Counter()
+        calls = 0
+        mismatches = 0
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.workers, initializer=init_worker, initargs=(db_name, shard_dir, args.excel)) as pool:
+            # largest campaigns first so no worker is left with a long tail
+            tasks = sorted(campaigns.items(), key=lambda task: -len(task[1]))
+            for result in pool.imap_unordered(replay_campaign, tasks):
+                calls += result['calls']
+                mismatches += result['snapshot_mismatches']
+                outcomes.update(result['outcomes'])
+                for label, values in result['latencies'].items():
+                    latencies[label].extend(values)
+        elapsed = time.perf_counter() - start
+
+        characters = {(step['campaign_id'], step['character_id']) for step in steps}
+        checksum, checksums = state_checksums(db_name, shards, characters)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = []
+    for label, values in sorted(latencies.items()):
+        results.append({
+            'steps': label,
+            'count': len(values),
+            'p50_ms': percentile(values, 50) * 1e3,
+            'p90_ms': percentile(values, 90) * 1e3,
+            'p99_ms': percentile(values, 99) * 1e3,
+            'max_ms': max(values) * 1e3,
+        })
+
+    columns = list(results[0])
+    print(' '.join(f'{column:>22}' for column in columns))
+    for result in results:
+        print(' '.join(f'{result[column]:>22.3f}' if isinstance(result[column], float) else f'{result[column]:>22}' for column in columns))
+    print(f'{len(steps)} steps, {calls} tool calls in {elapsed:.2f}s with {args.workers} workers: {calls / elapsed:.0f} ops/sec')
+    print('outcomes: ' + ', '.join(f'{name} {label}={count}' for (name, label), count in sorted(outcomes.items())))
+    print(f'snapshot mismatches: {mismatches}')
+    print(f'state checksum: {checksum} over {len(checksums)} characters')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({
+                'ops_per_sec': calls / elapsed,
+                'steps': len(steps),
+                'tool_calls': calls,
+                'elapsed_sec': elapsed,
+                'workers': args.workers,
+                'latency': results,
+                'outcomes': {f'{name}/{label}': count for (name, label), count in sorted(outcomes.items())},
+                'snapshot_mismatches': mismatches,
+                'checksum': checksum,
+                'checksums': checksums,
+            }, f, indent=2)
+
+if __name__ == '__main__':
+    main()